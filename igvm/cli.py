@@ -15,6 +15,7 @@ from igvm.commands import (
     disk_set,
     evacuate,
     host_info,
+    image_prefetch,
     mem_set,
     vcpu_set,
     vm_build,
@@ -27,6 +28,7 @@ from igvm.commands import (
     vm_sync,
 )
 from igvm.libvirt import close_virtconns
+from igvm.settings import IMAGE_PREFETCH_PARALLEL
 
 
 class ColorFormatters():
@@ -125,6 +127,11 @@ def parse_args():
         action='store_true',
         help='Rebuild already defined VM or build it if not defined',
     )
+    subparser.add_argument(
+        '--golden',
+        action='store_true',
+        help='Clone the storage from the golden volume of the image',
+    )
 
     subparser = subparsers.add_parser(
         'migrate',
@@ -166,7 +173,14 @@ def parse_args():
         '--offline-transport',
         default='drbd',
         help=(
-            'Specify drbd (default) or netcat transport to migrate disk image'
+            'Specify drbd (default), netcat, sparse, parallel, resumable '
+            'or precopy transport to migrate disk image.  Sparse is netcat '
+            'compressed and skipping zeros.  Parallel is netcat over '
+            'multiple connections with verification.  Resumable keeps the '
+            'disk on the target on failure, and sends only the missing '
+            'chunks when it is run again.  Precopy copies the disk from '
+            'a snapshot while the VM is running, and sends only the changed '
+            'chunks after it is shut down.'
         ),
     )
     subparser.add_argument(
@@ -177,6 +191,12 @@ def parse_args():
             ' operator to shut down VM.'
         ),
     )
+    subparser.add_argument(
+        '--max-bandwidth',
+        type=int,
+        metavar='MiB/s',
+        help='Limit the bandwidth used to migrate the VM',
+    )
 
     subparser = subparsers.add_parser(
         'change-address',
@@ -376,8 +396,62 @@ def parse_args():
         nargs='*',
         help='Migrate VMs matching the given serveradmin function offline',
     )
+    subparser.add_argument(
+        '--parallel',
+        type=int,
+        default=1,
+        help='Number of VMs to migrate at the same time',
+    )
+    subparser.add_argument(
+        '--parallel-per-destination',
+        type=int,
+        default=1,
+        help='Number of VMs to migrate to the same hypervisor at once',
+    )
+    subparser.add_argument(
+        '--max-bandwidth',
+        type=int,
+        metavar='MiB/s',
+        help='Limit the bandwidth used by all migrations together',
+    )
+    subparser.add_argument(
+        '--save-plan',
+        dest='save_plan_to',
+        metavar='FILE',
+        help='Save the placement of the VMs as JSON, requires --dry-run',
+    )
+    subparser.add_argument(
+        '--plan',
+        metavar='FILE',
+        help='Migrate the VMs to the hypervisors on the saved placement',
+    )
+
+    subparser = subparsers.add_parser(
+        'image-prefetch',
+        description=image_prefetch.__doc__,
+    )
+    subparser.set_defaults(func=image_prefetch)
+    subparser.add_argument(
+        'image',
+        help='Name of the image like "stretch-base.tar.gz"',
+    )
+    subparser.add_argument(
+        'hv_hostnames',
+        nargs='*',
+        help='Hostnames of the hypervisors, all online ones by default',
+    )
+    subparser.add_argument(
+        '--parallel',
+        type=int,
+        default=IMAGE_PREFETCH_PARALLEL,
+        help='Number of hypervisors to fetch the image at the same time',
+    )
+
+    args = top_parser.parse_args()
+    if getattr(args, 'save_plan_to', None) and not args.dry_run:
+        top_parser.error('--save-plan requires --dry-run')
 
-    return vars(top_parser.parse_args())
+    return vars(args)
 
 
 def main():
@@ -4,11 +4,15 @@ Copyright (c) 2018 InnoGames GmbH
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import Pool
 from os import environ
 from contextlib import contextmanager, ExitStack
 
 from adminapi.dataset import Query
 from adminapi.filters import Any, StartsWith
+from fabric.api import settings
 from fabric.colors import green, red, white, yellow
 from fabric.network import disconnect_all
 from ipaddress import ip_address
@@ -20,13 +24,20 @@ from igvm.exceptions import (
     IGVMError,
     InconsistentAttributeError,
     InvalidStateError,
+    UnsuitableHypervisorError,
 )
+from igvm.evacuation import EvacuationScheduler
 from igvm.host import with_fabric_settings
 from igvm.hypervisor import Hypervisor
 from igvm.hypervisor_preferences import sorted_hypervisors
+from igvm.libvirt import close_virtconns
+from igvm.planner import PlacementPlanner, load_plan, save_plan
 from igvm.settings import (
+    COMMON_FABRIC_SETTINGS,
     HYPERVISOR_ATTRIBUTES,
     HYPERVISOR_PREFERENCES,
+    HYPERVISOR_PROBE_WORKERS,
+    IMAGE_PREFETCH_PARALLEL,
     VM_ATTRIBUTES,
 )
 from igvm.transaction import Transaction
@@ -54,7 +65,9 @@ def _check_defined(vm, fail_hard=True):
 
 
 @with_fabric_settings
-def evacuate(hv_hostname, offline=None, dry_run=False):
+def evacuate(hv_hostname, offline=None, dry_run=False, parallel=1,
+             parallel_per_destination=1, max_bandwidth=None,
+             save_plan_to=None, plan=None):
     """Move all VMs out of a hypervisor
 
     Move all VMs out of a hypervisor and put it to state online reserved.
@@ -62,7 +75,17 @@ def evacuate(hv_hostname, offline=None, dry_run=False):
     Offline can be passed without arguments or with a list strings matching
     function attributes. If just passed all VMs will be migrated offline. If
     a list of strings is passed only those matching will be migrate offline.
+
+    Up to parallel VMs are migrated at the same time, up to
+    parallel_per_destination of them to the same hypervisor.  The optional
+    max_bandwidth in MiB/s is shared between them.
+
+    The placement of all VMs is planned at once on dry run.  The plan can
+    be saved to a JSON file with save_plan_to, reviewed, and executed later
+    by passing the file as plan.  The VMs missing on the plan are placed
+    as they are migrated.
     """
+    planned = load_plan(plan) if plan else {}
     with _get_hypervisor(hv_hostname, allow_reserved=True) as hv:
         if dry_run:
             log.info('I would set {} to state online reserved'.format(
@@ -71,22 +94,77 @@ def evacuate(hv_hostname, offline=None, dry_run=False):
             hv.dataset_obj['state'] = 'online_reserved'
             hv.dataset_obj.commit()
 
-        for vm in hv.dataset_obj['vms']:
-            vm_function = vm['function']
-
-            if (
-                offline is not None and
-                (offline == [] or vm_function in offline)
-            ):
-                if dry_run:
-                    log.info('Would migrate {} offline'.format(vm['hostname']))
-                else:
-                    vm_migrate(vm['hostname'], offline=True)
-            else:
-                if dry_run:
-                    log.info('Would migrate {} online'.format(vm['hostname']))
+        vms = []
+        hostnames = [v['hostname'] for v in hv.dataset_obj['vms']]
+        if hostnames:
+            for dataset_obj in Query({
+                'hostname': Any(*hostnames),
+                'servertype': 'vm',
+            }, VM_ATTRIBUTES):
+                if dataset_obj['hostname'] in planned:
+                    vm_offline = planned[dataset_obj['hostname']]['offline']
                 else:
-                    vm_migrate(vm['hostname'])
+                    vm_offline = offline is not None and (
+                        offline == [] or dataset_obj['function'] in offline
+                    )
+                vms.append((VM(dataset_obj, hv), vm_offline))
+
+        planner = PlacementPlanner(Hypervisor(o) for o in Query({
+            'servertype': 'hypervisor',
+            'environment': environ.get('IGVM_MODE', 'production'),
+            'state': 'online',
+        }, HYPERVISOR_ATTRIBUTES))
+        if dry_run:
+            placement = planner.plan(vms)
+            for migration in placement['migrations']:
+                log.info('I would migrate {} {} to {}'.format(
+                    migration['vm_hostname'],
+                    'offline' if migration['offline'] else 'online',
+                    migration['hypervisor_hostname'],
+                ))
+            if save_plan_to:
+                save_plan(placement, save_plan_to)
+                log.info('Saved the plan to {}'.format(save_plan_to))
+            return
+
+        scheduler = EvacuationScheduler(
+            _evacuate_vm,
+            planner,
+            max_per_source=parallel,
+            max_per_destination=parallel_per_destination,
+            max_bandwidth=max_bandwidth,
+        )
+        scheduler.run(vms, {
+            k: v['hypervisor_hostname'] for k, v in planned.items()
+        })
+
+
+def _evacuate_vm(vm_hostname, hypervisor_hostname, offline, max_bandwidth):
+    """Migrate a VM in a worker process of the evacuation
+
+    The destination hypervisor is already locked by the scheduler.  This
+    function is not decorated, because the worker processes cannot unpickle
+    the decorated functions.  The exceptions are converted by the scheduler.
+    """
+    try:
+        with ExitStack() as es:
+            es.enter_context(settings(**COMMON_FABRIC_SETTINGS))
+            vm = es.enter_context(_get_vm(vm_hostname, allow_retired=True))
+            hypervisor = es.enter_context(_get_hypervisor(
+                hypervisor_hostname, allow_reserved=True, lock=False
+            ))
+            # The scheduler chooses another hypervisor for the VM, if this
+            # one turns out not to be able to run it.
+            try:
+                hypervisor.check_vm(vm, offline or not vm.is_running())
+            except IGVMError as error:
+                raise UnsuitableHypervisorError(str(error))
+            _migrate(
+                vm, hypervisor, offline=offline, max_bandwidth=max_bandwidth
+            )
+    finally:
+        disconnect_all()
+        close_virtconns()
 
 
 @with_fabric_settings
@@ -226,10 +304,11 @@ def change_address(vm_hostname, new_address, offline=False):
 
 @with_fabric_settings
 def vm_build(vm_hostname, run_puppet=True, debug_puppet=False, postboot=None,
-             allow_reserved_hv=False, rebuild=False):
+             allow_reserved_hv=False, rebuild=False, golden=False):
     """Create a VM and start it
 
-    Puppet in run once to configure baseline networking.
+    Puppet in run once to configure baseline networking.  With golden, the
+    storage is cloned from a volume with the image already extracted.
     """
 
     with ExitStack() as es:
@@ -259,16 +338,18 @@ def vm_build(vm_hostname, run_puppet=True, debug_puppet=False, postboot=None,
             run_puppet=run_puppet,
             debug_puppet=debug_puppet,
             postboot=postboot,
+            golden=golden,
         )
 
         vm.dataset_obj.commit()
 
 
-@with_fabric_settings   # NOQA: C901
+@with_fabric_settings
 def vm_migrate(vm_hostname, hypervisor_hostname=None,
                run_puppet=False, debug_puppet=False,
                offline=False, offline_transport='drbd',
-               allow_reserved_hv=False, no_shutdown=False):
+               allow_reserved_hv=False, no_shutdown=False,
+               max_bandwidth=None):
     """Migrate a VM to a new hypervisor."""
     with ExitStack() as es:
         vm = es.enter_context(
@@ -290,53 +371,63 @@ def vm_migrate(vm_hostname, hypervisor_hostname=None,
                 offline,
             ))
 
-        was_running = vm.is_running()
+        _migrate(
+            vm, hypervisor, run_puppet, debug_puppet, offline,
+            offline_transport, no_shutdown, max_bandwidth,
+        )
 
-        # There is no point of online migration, if the VM is already shutdown.
-        if not was_running:
-            offline = True
 
-        if not offline and run_puppet:
-            raise IGVMError('Online migration cannot run Puppet.')
+def _migrate(vm, hypervisor, run_puppet=False, debug_puppet=False,
+             offline=False, offline_transport='drbd', no_shutdown=False,
+             max_bandwidth=None):
+    """Migrate a locked VM to the given hypervisor"""
+    was_running = vm.is_running()
 
-        # Validate destination hypervisor can run the VM (needs to happen after
-        # setting new IP!)
-        hypervisor.check_vm(vm, offline)
+    # There is no point of online migration, if the VM is already shutdown.
+    if not was_running:
+        offline = True
 
-        # Require VM to be in sync with serveradmin
-        _check_attributes(vm)
+    if not offline and run_puppet:
+        raise IGVMError('Online migration cannot run Puppet.')
 
-        vm.check_serveradmin_config()
+    # Validate destination hypervisor can run the VM (needs to happen after
+    # setting new IP!)
+    hypervisor.check_vm(vm, offline)
 
-        with Transaction() as transaction:
-            vm.hypervisor.migrate_vm(
-                vm, hypervisor, offline, offline_transport, transaction,
-                no_shutdown,
-            )
+    # Require VM to be in sync with serveradmin
+    _check_attributes(vm)
 
-            previous_hypervisor = vm.hypervisor
-            vm.hypervisor = hypervisor
+    vm.check_serveradmin_config()
 
-            def _reset_hypervisor():
-                vm.hypervisor = previous_hypervisor
-            transaction.on_rollback('reset hypervisor', _reset_hypervisor)
+    with Transaction() as transaction:
+        vm.hypervisor.migrate_vm(
+            vm, hypervisor, offline, offline_transport, transaction,
+            no_shutdown, max_bandwidth,
+        )
 
-            if run_puppet:
-                hypervisor.mount_vm_storage(vm, transaction)
-                vm.run_puppet(debug=debug_puppet)
-                hypervisor.umount_vm_storage(vm)
+        previous_hypervisor = vm.hypervisor
+        vm.hypervisor = hypervisor
 
-            if offline and was_running:
-                vm.start(transaction=transaction)
-            vm.reset_state()
+        def _reset_hypervisor():
+            vm.hypervisor = previous_hypervisor
+        transaction.on_rollback('reset hypervisor', _reset_hypervisor)
 
-            # Update Serveradmin
-            vm.dataset_obj['hypervisor'] = hypervisor.dataset_obj['hostname']
-            vm.dataset_obj.commit()
+        if run_puppet:
+            hypervisor.mount_vm_storage(vm, transaction)
+            vm.run_puppet(debug=debug_puppet)
+            hypervisor.umount_vm_storage(vm)
 
-        # If removing the existing VM fails we shouldn't risk undoing the newly
-        # migrated one.
-        previous_hypervisor.undefine_vm(vm)
+        if offline and was_running:
+            vm.start(transaction=transaction)
+        vm.reset_state()
+
+        # Update Serveradmin
+        vm.dataset_obj['hypervisor'] = hypervisor.dataset_obj['hostname']
+        vm.dataset_obj.commit()
+
+    # If removing the existing VM fails we shouldn't risk undoing the newly
+    # migrated one.
+    previous_hypervisor.undefine_vm(vm)
 
 
 @with_fabric_settings
@@ -595,6 +686,59 @@ def vm_rename(vm_hostname, new_hostname, offline=False):
         vm.rename(new_hostname)
 
 
+def image_prefetch(image, hv_hostnames=None,
+                   parallel=IMAGE_PREFETCH_PARALLEL):
+    """Fetch an image to the cache of many hypervisors
+
+    The image is fetched to all online hypervisors, unless the hypervisors
+    are given.  Up to parallel hypervisors fetch it at the same time.
+    """
+    if not hv_hostnames:
+        hv_hostnames = [o['hostname'] for o in Query({
+            'servertype': 'hypervisor',
+            'environment': environ.get('IGVM_MODE', 'production'),
+            'state': 'online',
+        }, ['hostname'])]
+
+    failed = {}
+    with Pool(parallel) as pool:
+        results = [
+            (h, pool.apply_async(_prefetch_image, (h, image)))
+            for h in hv_hostnames
+        ]
+        for hv_hostname, result in results:
+            try:
+                result.get()
+            except Exception as error:
+                log.error('Fetching {} to {} failed: {}'.format(
+                    image, hv_hostname, error
+                ))
+                failed[hv_hostname] = str(error)
+            else:
+                log.info('Fetched {} to {}'.format(image, hv_hostname))
+
+    if failed:
+        raise IGVMError('Failed to fetch {} to {} hypervisors: {}'.format(
+            image, len(failed), ', '.join(sorted(failed))
+        ))
+
+
+def _prefetch_image(hv_hostname, image):
+    """Fetch an image in a worker process of image_prefetch()"""
+    try:
+        with ExitStack() as es:
+            es.enter_context(settings(**COMMON_FABRIC_SETTINGS))
+            hypervisor = es.enter_context(_get_hypervisor(
+                hv_hostname, allow_reserved=True, lock=False
+            ))
+            hypervisor.fetch_image(image)
+    except Exception as error:
+        # We cannot rely on all of the exceptions to be picklable.
+        raise IGVMError(str(error))
+    finally:
+        disconnect_all()
+
+
 @contextmanager
 def _get_vm(hostname, unlock=True, allow_retired=False):
     """Get a server from Serveradmin by hostname to return VM object
@@ -649,7 +793,7 @@ def _get_vm(hostname, unlock=True, allow_retired=False):
 
 
 @contextmanager
-def _get_hypervisor(hostname, allow_reserved=False):
+def _get_hypervisor(hostname, allow_reserved=False, lock=True):
     """Get a server from Serveradmin by hostname to return Hypervisor object"""
     dataset_obj = Query({
         'hostname': hostname,
@@ -662,8 +806,11 @@ def _get_hypervisor(hostname, allow_reserved=False):
         )
 
     hypervisor = Hypervisor(dataset_obj)
-    hypervisor.acquire_lock()
+    if not lock:
+        yield hypervisor
+        return
 
+    hypervisor.acquire_lock()
     try:
         yield hypervisor
     finally:
@@ -679,42 +826,76 @@ def _get_best_hypervisor(vm, hypervisor_states, offline=False):
         'state': Any(*hypervisor_states),
     }, HYPERVISOR_ATTRIBUTES))
 
-    for hypervisor in sorted_hypervisors(
-        HYPERVISOR_PREFERENCES, vm, hypervisors
-    ):
-        # The actual resources are not checked during sorting for performance.
-        # We need to validate the hypervisor using the actual values before
-        # the final decision.
-        try:
-            hypervisor.acquire_lock()
-        except InvalidStateError as error:
-            log.warning(error)
-            continue
+    candidates = sorted_hypervisors(HYPERVISOR_PREFERENCES, vm, hypervisors)
+    while True:
+        # The next few hypervisors are probed at the same time, so we don't
+        # have to wait for the connections and the checks of the unsuitable
+        # ones one by one.
+        batch = list(islice(candidates, HYPERVISOR_PROBE_WORKERS))
+        if not batch:
+            raise IGVMError('Cannot find a hypervisor')
+
+        for hypervisor in _probe_hypervisors(vm, batch, offline):
+            # The actual resources are not checked during sorting for
+            # performance.  We need to validate the hypervisor using
+            # the actual values before the final decision.  The candidates
+            # are already probed, but we need to validate them again after
+            # locking.
+            try:
+                hypervisor.acquire_lock()
+            except InvalidStateError as error:
+                log.warning(error)
+                continue
 
+            try:
+                hypervisor.check_vm(vm, offline)
+            except libvirtError as error:
+                hypervisor.release_lock()
+                log.warning(
+                    'Preferred hypervisor "{}" is skipped: {}'
+                    .format(hypervisor, error)
+                )
+                continue
+            except HypervisorError as error:
+                hypervisor.release_lock()
+                log.warning(
+                    'Preferred hypervisor "{}" is skipped: {}'
+                    .format(hypervisor, error)
+                )
+                continue
+
+            try:
+                yield hypervisor
+            finally:
+                hypervisor.release_lock()
+            return
+
+
+def _probe_hypervisors(vm, hypervisors, offline=False):
+    """Validate the hypervisors concurrently and return the suitable ones
+
+    The suitable ones are returned in the original order.  All probes are
+    finished before, so that nothing is left running while the chosen
+    hypervisor is used.
+    """
+    with ThreadPoolExecutor(max_workers=len(hypervisors)) as executor:
+        futures = [
+            executor.submit(hypervisor.check_vm, vm, offline)
+            for hypervisor in hypervisors
+        ]
+
+    suitable = []
+    for hypervisor, future in zip(hypervisors, futures):
         try:
-            hypervisor.check_vm(vm, offline)
-        except libvirtError as error:
-            hypervisor.release_lock()
+            future.result()
+        except (libvirtError, HypervisorError) as error:
             log.warning(
                 'Preferred hypervisor "{}" is skipped: {}'
                 .format(hypervisor, error)
             )
             continue
-        except HypervisorError as error:
-            hypervisor.release_lock()
-            log.warning(
-                'Preferred hypervisor "{}" is skipped: {}'
-                .format(hypervisor, error)
-            )
-            continue
-
-        try:
-            yield hypervisor
-        finally:
-            hypervisor.release_lock()
-        break
-    else:
-        raise IGVMError('Cannot find a hypervisor')
+        suitable.append(hypervisor)
+    return suitable
 
 
 @contextmanager
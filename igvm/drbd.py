@@ -6,15 +6,40 @@ Copyright (c) 2018 InnoGames GmbH
 from contextlib import contextmanager
 from io import BytesIO
 from logging import getLogger
-from time import sleep
+import socket
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+from igvm.exceptions import StorageError
+from igvm.host import Batch, run_batches
+from igvm.settings import (
+    DRBD_EVENTS_POLL_INTERVAL,
+    DRBD_HARDWARE_PROFILES,
+    DRBD_PROFILES,
+    MIGRATE_PROGRESS_INTERVAL,
+)
+from igvm.transaction import Transaction
 
 log = getLogger(__name__)
 
+# Event streams by the hypervisors
+_events = {}
+_events_lock = Lock()
+
 
 class DRBD(object):
-    def __init__(self, hv, vm, master_role=False):
+    def __init__(self, hv, vm, master_role=False, max_rate=None,
+                 profile=None):
         self.hv = hv
         self.master_role = master_role
+        self.profile = profile or DRBD_PROFILES['default']
+        # Resync rate and its limit in MiB/s
+        self.max_rate = min(max_rate or float('inf'), self.profile['max_rate'])
+        self.rate = min(
+            max(self.profile['rate'], self.profile['min_rate']),
+            self.max_rate,
+        )
+        self.peer = None
 
         lv = vm.hypervisor.get_volume_by_vm(vm).path()
         lv_name = lv.split('/')
@@ -26,6 +51,7 @@ class DRBD(object):
 
         # Cached properties
         self.dev_minor = None
+        self.dev_size = None
         self.mapper_name = None
 
     def get_device_minor(self):
@@ -43,90 +69,79 @@ class DRBD(object):
         return 8000 + dev_minor
 
     def get_device_size(self):
-        return int(self.hv.run(
-            'lvs --noheadings '
-            '-o lv_size '
-            '--units b --nosuffix {}/{}'
-            .format(self.vg_name, self.lv_name)
-        ).strip())
-
-    @contextmanager
-    def start(self, peer):
-        """Start the replication
-
-        This is a context manager that would start the replication and stop
-        once we are done with it.  However we can only stop it properly after
-        all the initialization steps are successfully completed.  Therefore,
-        all of the initialization must handle cleaning up themselves.
-        """
-        with self.prepare_metadata_device(), self.build_config(peer):
-            if self.master_role:
-                self.replicate_to_slave()
-            else:
-                self.replicate_from_master()
-        try:
-            yield
-        finally:
-            self.stop()
+        if self.dev_size is None:
+            self.dev_size = int(self.hv.run(
+                'lvs --noheadings '
+                '-o lv_size '
+                '--units b --nosuffix {}/{}'
+                .format(self.vg_name, self.lv_name)
+            ).strip())
+        return self.dev_size
 
-    @contextmanager
-    def prepare_metadata_device(self):
-        """Create and zero metadata device for DRBD"""
+    def prepare(self, peer):
+        """Return the batch to set up this side until it is up
 
-        # 256MiB of metadata is fine up to 7TiB of synced storage.
-        self.hv.run(
-            'lvcreate -y -n {} -L256M {}'
-            .format(self.meta_disk, self.vg_name)
+        The sides are independent until they connect, so the batches of
+        both can run at the same time.  The rollback commands undo
+        the steps.
+        """
+        self.peer = peer
+        batch = Batch()
+
+        batch.run(
+            'lvcreate -y -n {} -L{}k --zero y --wipesignatures y {}'
+            .format(
+                self.meta_disk,
+                _metadata_size(self.get_device_size()),
+                self.vg_name,
+            ),
+            'lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk),
         )
-        try:
-            # Meta device must be zeroed, otherwise DRBD might complain
-            self.hv.run(
-                'dd if=/dev/zero of=/dev/{}/{} bs=1048576 count=256'
-                .format(self.vg_name, self.meta_disk)
+        # Meta device must be zeroed, otherwise DRBD might complain.
+        # The storage does it without transferring the zeros, if it can.
+        batch.run(
+            'blkdiscard -z /dev/{}/{}'.format(self.vg_name, self.meta_disk)
+        )
+
+        if self.master_role:
+            # Prepare logical volume to be overridden by DRBD device.  Dump
+            # mapper parameters of original LV, and create new device with
+            # mapping to location of it.
+            batch.run(
+                'dmsetup table /dev/{}/{} > {}'
+                .format(self.vg_name, self.lv_name, self.table_file)
             )
-            if self.master_role:
-                with self.prepare_lv_override():
-                    yield
-            else:
-                yield
-        except BaseException:
-            self.hv.run(
-                'lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk)
+            batch.run(
+                'dmsetup create {}_orig < {}'
+                .format(self.lv_name, self.table_file),
+                'dmsetup remove {}_orig'.format(self.lv_name),
             )
-            raise
 
-    @contextmanager
-    def prepare_lv_override(self):
-        """Prepare logical volume to be overridden by DRBD device"""
-
-        # Dump mapper parameters of original LV
-        self.hv.run(
-            'dmsetup table /dev/{}/{} > {}'
-            .format(self.vg_name, self.lv_name, self.table_file)
+        batch.put(
+            '/etc/drbd.d/{}.res'.format(self.vm_name),
+            self.build_config(peer),
+            '0640',
+            'rm /etc/drbd.d/{}.res'.format(self.vm_name),
         )
 
-        # Create new device with mapping to location of original LV
-        self.hv.run(
-            'dmsetup create {}_orig < {}'
-            .format(self.lv_name, self.table_file)
+        # The "up" command might fail due to misconfiguration but the device
+        # is started nevertheless.  This is why "down" rollback is attached
+        # to the step before.
+        batch.run(
+            'drbdadm create-md {}'.format(self.vm_name),
+            'drbdadm down {}'.format(self.vm_name),
         )
-        try:
-            yield
-        except BaseException:
-            self.hv.run('dmsetup remove {}_orig'.format(self.lv_name))
-            raise
+        batch.run('drbdadm up {}'.format(self.vm_name))
+
+        return batch
 
-    @contextmanager
     def build_config(self, peer):
         fd = BytesIO()
         fd.write(
             'resource {dev} {{\n'
             '    net {{\n'
             '        protocol C;\n'
-            # max-buffers vs MB/s
-            # 4k-150, 8k-233, 12k-330, 16K-397, 24k-561, 32k-700
-            # 32k seems jumpy and might end up at as low aw 250MB/s
-            '        max-buffers 24k;\n'
+            '        max-buffers {max_buffers};\n'
             # Buffer sizes don't seem to make any difference, at least within
             # one datacenter.
             '#        sndbuf-size 2048k;\n'
@@ -134,24 +149,21 @@ class DRBD(object):
             '    }}\n'
             '    disk {{\n'
             # Try maximum speed immediately, no need for the slow-start
-            '         c-max-rate 750M;\n'
-            '         resync-rate 750M;\n'
+            '         c-max-rate {rate}M;\n'
+            '         resync-rate {rate}M;\n'
             '    }}\n'
             '{src_host}\n'
             '{dst_host}\n'
             '}}\n'
             .format(
                 dev=self.vm_name,
+                max_buffers=self.profile['max_buffers'],
+                rate=self.rate,
                 src_host=self.get_host_config(),
                 dst_host=peer.get_host_config(),
             ).encode()
         )
-        self.hv.put('/etc/drbd.d/{}.res'.format(self.vm_name), fd, '0640')
-        try:
-            yield
-        except BaseException:
-            self.hv.run('rm /etc/drbd.d/{}.res'.format(self.vm_name))
-            raise
+        return fd
 
     def get_host_config(self):
         return (
@@ -177,130 +189,372 @@ class DRBD(object):
             )
         )
 
-    def replicate_to_slave(self, transaction=None):
+    def replicate_to_slave(self, transaction):
         # Size must be retrieved before suspending device
         dev_size = self.get_device_size()
 
-        # Suspend all traffic to disk from VM
-        self.hv.run(
-            'dmsetup suspend /dev/{}/{}'.format(self.vg_name, self.lv_name)
-        )
-        try:
-            # Start DRBD on device
-            self.hv.run('drbdadm create-md {}'.format(self.vm_name))
-            self.hv.run('drbdadm up {}'.format(self.vm_name))
+        # The VM is suspended only as long as it takes to replace the device
+        # which it talks to on-fly.
+        with self.hv.batch(transaction) as batch:
+            # Suspend all traffic to disk from VM
+            batch.run(
+                'dmsetup suspend /dev/{}/{}'
+                .format(self.vg_name, self.lv_name),
+                'dmsetup resume /dev/{}/{}'.format(self.vg_name, self.lv_name),
+            )
 
             # Enforce primary operation and sync to secondary with
             # overwriting of data
-            self.hv.run(
+            batch.run(
                 'drbdadm -- --overwrite-data-of-peer primary {}'
                 .format(self.vm_name)
             )
 
-            # DRBD is finally up, now replace device which VM talks to on-fly.
-            # In Device Mapper block is always 512 bytes.
-            self.hv.run(
+            # In Device Mapper block is always 512 bytes.  There should be
+            # no need to load the original table on rollback, because the
+            # table is only loaded to the inactive slot.  Unfortunately, it
+            # is needed because DRBD won't allow to be shut down when its
+            # device is still held open by somebody.  Also see the comment
+            # about active and inactive slots in stop() method.
+            # WARNING: Potential race between writes to DRBD and underlying
+            # device - potential data loss?
+            # TODO: suspend VM for rollback
+            batch.run(
                 'dmsetup load /dev/{}/{} --table "0 {} linear /dev/drbd{} 0"'
                 .format(
                     self.vg_name, self.lv_name,
                     dev_size // 512,
                     self.get_device_minor(),
-                )
+                ),
+                'dmsetup load /dev/{}/{} < {}'
+                .format(self.vg_name, self.lv_name, self.table_file),
             )
-            try:
-                self.hv.run(
-                    'dmsetup resume /dev/{}/{}'
-                    .format(self.vg_name, self.lv_name)
-                )
-            except BaseException:
-                # There should be no need for resume because it happens also
-                # via another rollback defined above.  Unfortunately, it is
-                # needed because DRBD won't allow to be shut down when its
-                # device is still held open by somebody.  Also see the comment
-                # about active and inactive slots in stop() method.
-                # WARNING: Potential race between writes to DRBD and underlying
-                # device - potential data loss?
-                # TODO: suspend VM for rollback
-                self.hv.run(
+            batch.run(
+                'dmsetup resume /dev/{}/{}'.format(self.vg_name, self.lv_name)
+            )
+
+    def replicate_from_master(self, transaction):
+        self.hv.run('drbdadm wait-connect {}'.format(self.vm_name))
+
+    def wait_for_sync(self):
+        get_events(self.hv).wait_for_sync(
+            self.vm_name, self.adjust_rate if self.master_role else None
+        )
+
+    def adjust_rate(self, resource):
+        """Adjust the resync rate of both sides by the measured throughput
+
+        The rate is raised while the resync is keeping up with it, and
+        lowered towards the throughput while it is falling far behind,
+        so that the resync does not compete with the VMs for the disks
+        any more than it gets out of it.
+        """
+        throughput = resource.throughput()
+        if throughput is None:
+            return
+        throughput /= 1024
+
+        if throughput >= self.rate * 0.9:
+            rate = self.rate * 1.25
+        elif throughput < self.rate * 0.5:
+            rate = throughput * 1.25
+        else:
+            return
+        # The bandwidth limit wins over the minimum rate of the profile.
+        rate = int(min(max(rate, self.profile['min_rate']), self.max_rate))
+        if rate == self.rate:
+            return
+
+        log.info('Adjusting DRBD resync rate of {} from {} to {} MiB/s'.format(
+            self.vm_name, self.rate, rate
+        ))
+        for drbd in [self, self.peer]:
+            drbd.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.hv.run(
+            'drbdsetup disk-options {0} --c-max-rate={1}M --resync-rate={1}M'
+            .format(self.get_device_minor(), rate),
+            silent=True,
+        )
+        self.rate = rate
+
+    def stop(self):
+        with self.hv.batch() as batch:
+            if self.master_role:
+                batch.run(
                     'dmsetup load /dev/{}/{} < {}'
                     .format(self.vg_name, self.lv_name, self.table_file)
                 )
-                self.hv.run(
-                    'dmsetup resume /dev/{}/{}'
-                    .format(self.vg_name, self.lv_name)
-                )
-                raise
-        except BaseException:
-            # The "up" command might fail due to misconfiguration but the
-            # device is started nevertheless. This is why "down" rollback is
-            # always performed.
-            self.hv.run('drbdadm down {}'.format(self.vm_name))
-            self.hv.run(
-                'dmsetup resume /dev/{}/{}'.format(self.vg_name, self.lv_name)
+                batch.run('dmsetup resume /dev/{}/{}'.format(
+                    self.vg_name, self.lv_name
+                ))
+
+            # One would expect that DRBD must be shut down after table load
+            # and before resume. Unfortunately that is impossible because
+            # table is loaded to inactive slot and the old table with DRBD
+            # device is still there holding it locked. Only after resuming
+            # the device its table is fully updated. Do we risk data loss
+            # here? Probably yes. But since we shut down source VM before
+            # DRBD is stopped and start the target VM only after that, all
+            # is safe.
+            batch.run('drbdadm down {}'.format(self.vm_name))
+
+            if self.master_role:
+                batch.run('dmsetup remove {}_orig'.format(self.lv_name))
+
+            batch.run(
+                'lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk)
             )
-            raise
+            batch.run('rm /etc/drbd.d/{}.res'.format(self.vm_name))
+
+
+class DRBDEvents(object):
+    """Follow the events of the DRBD resources of a hypervisor
+
+    A single "drbdsetup events2" stream is kept open for every hypervisor.
+    Its records update the states and the statistics of all resources
+    on the hypervisor, and wake up the threads waiting for them.
+    """
+    def __init__(self, hv):
+        self.hv = hv
+        self.resources = {}
+        self.condition = Condition()
+        self.initialized = False
+        self.running = False
+        self.channel = None
+
+    def start(self):
+        # Without polling, the records are only written on state changes,
+        # so the statistics would not be updated during the resync.
+        self.channel = self.hv.open_channel(
+            'drbdsetup events2 --poll --statistics all'
+        )
+        self.running = True
+        for target, name in [
+            (self._follow, 'drbd-events-{}'),
+            (self._poll, 'drbd-events-poll-{}'),
+        ]:
+            thread = Thread(target=target, name=name.format(self.hv))
+            thread.daemon = True
+            thread.start()
+
+    def _poll(self):
+        """Request the current statistics periodically"""
+        while self.running:
+            sleep(DRBD_EVENTS_POLL_INTERVAL)
+            try:
+                self.channel.sendall(b'n\n')
+            except socket.error:
+                break
 
-    def replicate_from_master(self, transaction=None):
-        self.hv.run('drbdadm create-md {}'.format(self.vm_name))
-        self.hv.run('drbdadm up {}'.format(self.vm_name))
+    def _follow(self):
         try:
-            self.hv.run('drbdadm wait-connect {}'.format(self.vm_name))
-        except BaseException:
-            self.hv.run('drbdadm down {}'.format(self.vm_name))
-            raise
+            for line in self.channel.makefile('r'):
+                self.handle(line.split())
+        finally:
+            self.channel.close()
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
 
-    def wait_for_sync(self):
-        # Display a "nice" progress bar
-        show_progress = True
-        while show_progress:
-            lines = iter(self.hv.read_file('/proc/drbd').splitlines())
-            for line in lines:
-                line = line.decode()
-                if '{}: cs:'.format(self.get_device_minor()) in line:
-                    if 'ds:UpToDate/UpToDate' in line:
-                        show_progress = False
-                    try:
-                        next(lines)
-                        line = next(lines).decode()
-                    except StopIteration:
-                        log.warning(
-                            'Could not find progress bar, '
-                            'migrating without it!'
-                        )
-                        show_progress = False
-                    else:
-                        log.info(line)
-                    break
+    def handle(self, fields):
+        """Update the resources with a record of the stream
+
+        The records look like "change peer-device name:vm1 volume:0
+        replication:SyncSource peer-disk:Inconsistent out-of-sync:1024".
+        The initial states are followed by an "exists -" record.
+        """
+        if fields == ['exists', '-']:
+            with self.condition:
+                self.initialized = True
+                self.condition.notify_all()
+            return
+        if len(fields) < 2:
+            return
+
+        attributes = dict(f.split(':', 1) for f in fields[2:] if ':' in f)
+        name = attributes.pop('name', None)
+        if name is None:
+            return
+
+        with self.condition:
+            if fields[:2] == ['destroy', 'resource']:
+                self.resources.pop(name, None)
             else:
-                # Exit the loop if status for current device can't be found
-                show_progress = False
-            sleep(1)
+                resource = self.resources.get(name)
+                if resource is None:
+                    resource = self.resources[name] = DRBDResource(name)
+                resource.update(attributes)
+            self.condition.notify_all()
 
-        # Progress bar does not determine if disks were synced.
-        # Wait for sync to be reported by DRBD.
-        self.hv.run('drbdsetup wait-sync {}'.format(self.get_device_minor()))
+    def wait_for_sync(self, name, on_progress=None):
+        """Wait for both disks of the resource to be up to date
 
-    def stop(self):
-        if self.master_role:
-            self.hv.run(
-                'dmsetup load /dev/{}/{} < {}'
-                .format(self.vg_name, self.lv_name, self.table_file)
+        The progress is logged, and passed to the callback, periodically.
+        """
+        last_progress = time()
+        while True:
+            with self.condition:
+                resource = self.resources.get(name)
+                if resource is not None and resource.synced():
+                    break
+                if not self.running:
+                    raise StorageError(
+                        'Lost the DRBD events of {}'.format(self.hv)
+                    )
+                if resource is None and self.initialized:
+                    raise StorageError(
+                        'DRBD resource {} not found on {}'
+                        .format(name, self.hv)
+                    )
+
+                self.condition.wait(MIGRATE_PROGRESS_INTERVAL)
+                if (
+                    resource is None or
+                    time() - last_progress < MIGRATE_PROGRESS_INTERVAL
+                ):
+                    continue
+                log.info(resource.progress())
+                last_progress = time()
+
+            # The callback may run commands, the stream must not wait for it.
+            if on_progress:
+                on_progress(resource)
+        log.info('DRBD resource {} is synced on {}'.format(name, self.hv))
+
+
+class DRBDResource(object):
+    """State and statistics of a DRBD resource from its events"""
+    def __init__(self, name):
+        self.name = name
+        self.disk = None
+        self.peer_disk = None
+        self.replication = None
+        # Remaining data to sync in KiB
+        self.out_of_sync = None
+        self.done = None
+        self.size = None
+        # Out of sync data samples for the throughput
+        self.samples = []
+
+    def update(self, attributes):
+        self.disk = attributes.get('disk', self.disk)
+        self.peer_disk = attributes.get('peer-disk', self.peer_disk)
+        self.replication = attributes.get('replication', self.replication)
+        if 'size' in attributes:
+            self.size = int(attributes['size'])
+        if 'done' in attributes:
+            self.done = float(attributes['done'])
+        if 'out-of-sync' in attributes:
+            self.out_of_sync = int(attributes['out-of-sync'])
+            self.samples.append((time(), self.out_of_sync))
+            # Keep the samples of the last interval for the throughput
+            while (
+                len(self.samples) > 2 and
+                self.samples[-1][0] - self.samples[1][0] >=
+                MIGRATE_PROGRESS_INTERVAL
+            ):
+                del self.samples[0]
+
+    def synced(self):
+        return self.disk == 'UpToDate' and self.peer_disk == 'UpToDate'
+
+    def throughput(self):
+        """Return the sync throughput in KiB/s, or None if unknown"""
+        if len(self.samples) < 2:
+            return None
+        start_time, start = self.samples[0]
+        end_time, end = self.samples[-1]
+        if end_time <= start_time:
+            return None
+        return max(start - end, 0) / (end_time - start_time)
+
+    def progress(self):
+        throughput = self.throughput()
+        if self.done is not None:
+            done = '{:.1f}%'.format(self.done)
+        elif self.out_of_sync is not None and self.size:
+            done = '{:.1f}%'.format(
+                100.0 - 100.0 * self.out_of_sync / self.size
+            )
+        else:
+            done = 'unknown'
+        return (
+            'DRBD resource {}: {} {}/{}, {} done, {}, ETA {}'
+            .format(
+                self.name,
+                self.replication,
+                self.disk,
+                self.peer_disk,
+                done,
+                '{:.0f} MiB/s'.format(throughput / 1024)
+                if throughput is not None else 'throughput unknown',
+                '{:.0f} s'.format(self.out_of_sync / throughput)
+                if throughput and self.out_of_sync is not None
+                else 'unknown',
             )
-            self.hv.run('dmsetup resume /dev/{}/{}'.format(
-                self.vg_name, self.lv_name
-            ))
-
-        # One would expect that DRBD must be shut down after table load and
-        # before resume. Unfortunately that is impossible because table is
-        # loaded to inactive slot and the old table with DRBD device is still
-        # there holding it locked. Only after resuming the device its table
-        # is fully updated. Do we risk data loss here? Probably yes. But since
-        # we shut down source VM before DRBD is stopped and start the target VM
-        # only after that, all is safe.
-        self.hv.run('drbdadm down {}'.format(self.vm_name))
+        )
 
-        if self.master_role:
-            self.hv.run('dmsetup remove {}_orig'.format(self.lv_name))
 
-        self.hv.run('lvremove -fy {}/{}'.format(self.vg_name, self.meta_disk))
-        self.hv.run('rm /etc/drbd.d/{}.res'.format(self.vm_name))
+def get_events(hv):
+    """Return the event stream of the hypervisor, start it if necessary"""
+    with _events_lock:
+        events = _events.get(hv)
+        if events is None or not events.running:
+            events = _events[hv] = DRBDEvents(hv)
+            events.start()
+        return events
+
+
+@contextmanager
+def replicate(master, slave):
+    """Replicate the storage from the master to the slave
+
+    This is a context manager that would start the replication and stop
+    once we are done with it.  The preparation of both sides runs at
+    the same time, and joins when the slave waits for the master to
+    connect.  The steps are undone if the start fails.
+    """
+    # The minors of both sides are needed for the configs of both.
+    master.get_device_minor()
+    slave.get_device_minor()
+
+    with Transaction() as transaction:
+        run_batches(
+            [
+                (master.hv, master.prepare(slave)),
+                (slave.hv, slave.prepare(master)),
+            ],
+            transaction,
+        )
+        master.replicate_to_slave(transaction)
+        slave.replicate_from_master(transaction)
+    try:
+        yield
+    finally:
+        slave.stop()
+        master.stop()
+
+
+def get_tuning_profile(*hvs):
+    """Return the slowest tuning profile of the hypervisors"""
+    return min(
+        (
+            DRBD_PROFILES[DRBD_HARDWARE_PROFILES.get(
+                hv.dataset_obj['hardware_model'], 'default'
+            )]
+            for hv in hvs
+        ),
+        key=lambda p: p['max_rate'],
+    )
+
+
+def _metadata_size(device_size):
+    """Return the size of the external metadata of a device in KiB
+
+    This is the formula of the DRBD User's Guide for a single peer
+    Ms = ceil(Cs / 2^18) * 8 + 72, where the sizes are in sectors.
+    """
+    sectors = -(-device_size // 512)
+    return (-(-sectors // 2 ** 18) * 8 + 72) // 2
@@ -0,0 +1,276 @@
+"""igvm - Evacuation Scheduler
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+import logging
+from multiprocessing import Pool
+from time import sleep, time
+
+from igvm.exceptions import (
+    IGVMError,
+    InvalidStateError,
+    UnsuitableHypervisorError,
+)
+from igvm.planner import largest_first
+from igvm.settings import EVACUATION_PROGRESS_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class EvacuationScheduler(object):
+    """Run the migrations out of a hypervisor concurrently
+
+    The migrations are run in worker processes, because Fabric keeps its
+    state globally.  The destinations are taken from the plan or chosen by
+    the planner as the migrations are started.  The planner accounts for
+    the resources claimed by the migrations still in flight.
+
+    The destinations are chosen from the Serveradmin data, so they can
+    still turn out not to be able to run the VMs.  The migrate function
+    raises UnsuitableHypervisorError then, and the VM is placed again
+    excluding that hypervisor.
+
+    The destination hypervisors are locked in here for as long as there are
+    migrations in flight to them.  This allows the workers to migrate
+    multiple VMs to the same hypervisor at the same time.  The workers must
+    not lock the destination hypervisors themselves.
+    """
+    def __init__(self, migrate, planner, max_per_source=1,
+                 max_per_destination=1, max_bandwidth=None):
+        """Initialize the scheduler
+
+        :param migrate: Function to run in the workers for every VM with
+                        the arguments VM hostname, hypervisor hostname,
+                        offline and max bandwidth
+        :param planner: PlacementPlanner to choose the destinations
+        :param max_per_source: Number of migrations to run concurrently
+        :param max_per_destination: Number of migrations to run
+                                    concurrently to the same hypervisor
+        :param max_bandwidth: Bandwidth budget in MiB/s to share between
+                              the concurrent migrations
+        """
+        self.migrate = migrate
+        self.planner = planner
+        self.max_per_source = max_per_source
+        self.max_per_destination = max_per_destination
+        self.max_bandwidth = max_bandwidth
+
+        self._pending = []
+        self._planned = {}
+        self._running = {}
+        self._in_flight = {}
+        self._unavailable = set()
+        self._rejected = {}
+        self._durations = []
+        self._failed = {}
+        self._start_time = None
+        self._last_progress = None
+
+    def bandwidth_per_migration(self):
+        """Return the share of the bandwidth budget of a migration"""
+        if not self.max_bandwidth:
+            return None
+        return max(self.max_bandwidth // self.max_per_source, 1)
+
+    def run(self, vms, plan=None):
+        """Migrate the VMs, raise IGVMError if any of them fails
+
+        The VMs are given as tuples with the offline flag.  The plan maps
+        the VM hostnames to the destination hostnames.  The VMs missing on
+        it are placed as they are started.
+        """
+        self._pending = largest_first(vms)
+        for vm, offline in self._pending:
+            hypervisor = self.planner.get_hypervisor((plan or {}).get(vm.fqdn))
+            if hypervisor is not None:
+                self.planner.assign(vm, hypervisor)
+                self._planned[vm] = hypervisor
+        self._start_time = self._last_progress = time()
+        total = len(self._pending)
+
+        # Every migration runs in a new process to start with clean
+        # connections.
+        pool = Pool(self.max_per_source, maxtasksperchild=1)
+        try:
+            while self._pending or self._running:
+                changed = self._collect()
+                changed = self._schedule(pool) or changed
+                if changed or (
+                    time() - self._last_progress >
+                    EVACUATION_PROGRESS_INTERVAL
+                ):
+                    self._log_progress(total)
+                sleep(1)
+        finally:
+            # The workers got the interrupt as well.  We need to wait for
+            # them to roll back their migrations, before the destinations
+            # are unlocked.
+            pool.close()
+            try:
+                pool.join()
+            except BaseException:
+                pool.terminate()
+                log.error(
+                    'Killed the migrations in flight, leaving {} locked'
+                    .format(', '.join(str(h) for h in self._in_flight))
+                )
+                raise
+            for hypervisor in list(self._in_flight):
+                self._release(hypervisor)
+
+        if self._failed:
+            raise IGVMError('Failed to migrate {} VMs: {}'.format(
+                len(self._failed),
+                ', '.join(
+                    '{} ({})'.format(k, v) for k, v in self._failed.items()
+                ),
+            ))
+
+    def _schedule(self, pool):
+        """Start as many migrations as the limits allow"""
+        changed = False
+        for vm, offline in list(self._pending):
+            if len(self._running) >= self.max_per_source:
+                break
+
+            hypervisor = self._planned.get(vm)
+            if hypervisor is not None and hypervisor in self._unavailable:
+                self.planner.unassign(vm, hypervisor)
+                del self._planned[vm]
+                hypervisor = None
+            if hypervisor is None:
+                hypervisor = self.planner.choose(vm, exclude=(
+                    self._unavailable |
+                    self._full_hypervisors() |
+                    self._rejected.get(vm, set())
+                ))
+                if hypervisor is None:
+                    if not self._running:
+                        # Nothing is going to free up any capacity.
+                        self._pending.remove((vm, offline))
+                        self._failed[vm.fqdn] = 'Cannot find a hypervisor'
+                        changed = True
+                    continue
+                self.planner.assign(vm, hypervisor)
+                self._planned[vm] = hypervisor
+            elif hypervisor in self._full_hypervisors():
+                continue
+
+            if not self._in_flight.get(hypervisor):
+                try:
+                    hypervisor.acquire_lock()
+                except InvalidStateError as error:
+                    log.warning(error)
+                    self._unavailable.add(hypervisor)
+                    continue
+                self._in_flight[hypervisor] = 0
+
+            self._in_flight[hypervisor] += 1
+            self._pending.remove((vm, offline))
+            log.info('Migrating {} {} to {}'.format(
+                vm, 'offline' if offline else 'online', hypervisor
+            ))
+            result = pool.apply_async(_run_migration, (
+                self.migrate,
+                vm.fqdn,
+                hypervisor.fqdn,
+                offline,
+                self.bandwidth_per_migration(),
+            ))
+            self._running[vm] = (result, hypervisor, offline, time())
+            changed = True
+
+        return changed
+
+    def _collect(self):
+        """Process the finished migrations"""
+        changed = False
+        for vm, (result, hypervisor, offline, start_time) in list(
+            self._running.items()
+        ):
+            if not result.ready():
+                continue
+
+            del self._running[vm]
+            changed = True
+            try:
+                result.get()
+            except UnsuitableHypervisorError as error:
+                log.warning('{} cannot run {}, placing it again: {}'.format(
+                    hypervisor, vm, error
+                ))
+                self.planner.unassign(vm, hypervisor)
+                del self._planned[vm]
+                self._rejected.setdefault(vm, set()).add(hypervisor)
+                self._pending = largest_first(
+                    self._pending + [(vm, offline)]
+                )
+            except Exception as error:
+                log.error('Migration of {} to {} failed: {}'.format(
+                    vm, hypervisor, error
+                ))
+                self._failed[vm.fqdn] = str(error)
+                self.planner.unassign(vm, hypervisor)
+            else:
+                log.info('Migrated {} to {}'.format(vm, hypervisor))
+                self._durations.append(time() - start_time)
+
+            self._in_flight[hypervisor] -= 1
+            if not self._in_flight[hypervisor]:
+                self._release(hypervisor)
+
+        return changed
+
+    def _full_hypervisors(self):
+        """Return the hypervisors at the limit of concurrent migrations"""
+        return {
+            h for h, n in self._in_flight.items()
+            if n >= self.max_per_destination
+        }
+
+    def _release(self, hypervisor):
+        del self._in_flight[hypervisor]
+        hypervisor.release_lock()
+
+    def _log_progress(self, total):
+        self._last_progress = time()
+        done = len(self._durations)
+        remaining = len(self._pending) + len(self._running)
+
+        eta = 'unknown'
+        if self._durations:
+            average = sum(self._durations) / len(self._durations)
+            eta = '{:.0f} min'.format(
+                average * remaining / self.max_per_source / 60
+            )
+
+        log.info(
+            'Evacuation progress: {}/{} migrated, {} failed, {} running, '
+            '{} pending, {:.0f} min elapsed, ETA {}'
+            .format(
+                done,
+                total,
+                len(self._failed),
+                len(self._running),
+                len(self._pending),
+                (time() - self._start_time) / 60,
+                eta,
+            )
+        )
+
+
+def _run_migration(migrate, *args):
+    """Run the migration in a worker, always return a result
+
+    The worker exiting with an exception that is not an Exception, like
+    KeyboardInterrupt, would lose the result, and the pool would wait
+    for it forever.  We cannot rely on all exceptions to be picklable
+    either.
+    """
+    try:
+        return migrate(*args)
+    except UnsuitableHypervisorError:
+        raise
+    except BaseException as error:
+        raise IGVMError(str(error) or error.__class__.__name__)
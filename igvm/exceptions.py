@@ -18,6 +18,11 @@ class HypervisorError(IGVMError):
     pass
 
 
+class UnsuitableHypervisorError(HypervisorError):
+    """The hypervisor cannot run the VM."""
+    pass
+
+
 class NetworkError(IGVMError):
     pass
 
@@ -3,8 +3,14 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from io import BytesIO
 from datetime import datetime
+from logging import getLogger
+from shlex import quote
+from threading import Lock, Semaphore
 
 import fabric.api
 import fabric.state
@@ -13,10 +19,16 @@ from uuid import uuid4
 
 from paramiko import transport
 from igvm.exceptions import RemoteCommandError, InvalidStateError
-from igvm.settings import COMMON_FABRIC_SETTINGS
+from igvm.settings import COMMON_FABRIC_SETTINGS, SSH_MAX_CHANNELS
 
 from adminapi.dataset import DatasetError
 
+log = getLogger(__name__)
+
+# Semaphores to limit the concurrent channels by the host strings
+_channel_limits = {}
+_channel_limits_lock = Lock()
+
 
 def with_fabric_settings(fn):
     """Decorator to run a function with COMMON_FABRIC_SETTINGS."""
@@ -102,6 +114,100 @@ class Host(object):
                 else:
                     return fabric.api.run(*args, **kwargs)
 
+    @contextmanager
+    def batch(self, transaction=None, silent=False):
+        """Collect commands and file writes to run them as one script
+
+        The script is run on the remote host in a single round trip after
+        the block.  It stops on the first failing step and RemoteCommandError
+        is raised.  The rollback commands of the succeeded steps are
+        registered on the transaction.  The outputs and the exit codes of
+        the steps are available on the batch afterwards.
+        """
+        batch = Batch()
+        yield batch
+        if not batch.steps:
+            return
+
+        marker = 'igvm-batch-{}'.format(uuid4().hex)
+        batch.parse(self._run_script(batch.script(marker), silent), marker)
+        self._finish_batch(batch, transaction)
+
+    def _finish_batch(self, batch, transaction=None):
+        for (command, rollback), (return_code, output) in zip(
+            batch.steps, batch.results
+        ):
+            if return_code == 0 and rollback and transaction:
+                transaction.on_rollback(
+                    'run "{}"'.format(rollback), self.run, rollback
+                )
+
+        if len(batch.results) < len(batch.steps):
+            if batch.results and batch.results[-1][0] != 0:
+                return_code, output = batch.results[-1]
+                raise RemoteCommandError(
+                    '"{}" failed with status {}: {}'.format(
+                        batch.steps[len(batch.results) - 1][0],
+                        return_code,
+                        output,
+                    )
+                )
+            raise RemoteCommandError(
+                'Batch on "{}" stopped after {} of {} steps'.format(
+                    self.fqdn, len(batch.results), len(batch.steps)
+                )
+            )
+
+    def _run_script(self, script, silent=False):
+        return self.run(script, silent=silent, warn_only=True, pty=False)
+
+    def run_parallel(self, commands, silent=False, with_sudo=True):
+        """Run independent commands on the remote host at the same time
+
+        Every command runs on its own channel of the SSH connection to
+        the host instead of opening new connections.  The concurrent
+        channels are limited per host, because the SSH servers limit
+        the sessions of a connection.
+
+        :return: List of the outputs of the commands
+        """
+        if not commands:
+            return []
+
+        with self.fabric_settings():
+            transport = self._get_transport()
+            limit = _get_channel_limit(fabric.api.env.host_string)
+
+        with ThreadPoolExecutor(min(len(commands), SSH_MAX_CHANNELS)) as ex:
+            return list(ex.map(
+                lambda c: _run_on_channel(transport, limit, c, silent,
+                                          with_sudo),
+                commands,
+            ))
+
+    def open_channel(self, command, with_sudo=True):
+        """Start a long running command on its own channel
+
+        The caller reads the output from the channel, and closes it once
+        it is done.  The channel is not counted against the concurrent
+        channels of run_parallel().
+        """
+        with self.fabric_settings():
+            transport = self._get_transport()
+        channel = transport.open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(_shell_command(command, with_sudo))
+        return channel
+
+    def _get_transport(self):
+        """Return the SSH transport of the host, reconnect if it is lost"""
+        host = fabric.api.env.host_string
+        transport = fabric.state.connections[host].get_transport()
+        if not transport.is_active():
+            del fabric.state.connections[host]
+            transport = fabric.state.connections[host].get_transport()
+        return transport
+
     def file_exists(self, *args, **kwargs):
         """Run a fabric.contrib.files.exists on this host with sudo."""
         with self.fabric_settings():
@@ -123,20 +229,31 @@ class Host(object):
             fabric.api.get(path, fd)
             return fd.getvalue()
 
-    def put(self, remote_path, local_path, mode='0644'):
+    def put(self, remote_path, local_path, mode='0644', owner=None):
         """Same as Fabric's put but with working sudo permissions
 
         Setting permissions on files and using sudo via Fabric's put() seems
-        broken, at least for mounted VM.  This is why we run extra commands
-        in here.
+        broken.  This is why we stream the contents to install on the remote
+        host instead, which places the file with the mode and the owner in
+        a single command.
+
+        :param local_path: Path or file object to upload
         """
+        if hasattr(local_path, 'getvalue'):
+            contents = local_path.getvalue()
+        else:
+            with open(local_path, 'rb') as fd:
+                contents = fd.read()
+
+        command = 'install -m {}'.format(mode)
+        if owner is not None:
+            command += ' -o {}'.format(owner)
+        command += ' /dev/stdin {}'.format(remote_path)
+
         with self.fabric_settings():
-            tempfile = '/tmp/' + str(uuid4())
-            fabric.api.put(local_path, tempfile)
-            self.run(
-                'mv {0} {1} ; chmod {2} {1}'
-                .format(tempfile, remote_path, mode)
-            )
+            transport = self._get_transport()
+            limit = _get_channel_limit(fabric.api.env.host_string)
+        _run_on_channel(transport, limit, command, True, True, contents)
 
     def acquire_lock(self, allow_fail=False):
         if self.dataset_obj['igvm_locked'] is not None:
@@ -183,3 +300,132 @@ class Host(object):
             .format(bs_kib, device)
         )
         self.run('sync')
+
+
+class Batch(object):
+    """Steps to run on a remote host as one script, see Host.batch()"""
+    def __init__(self):
+        self.steps = []
+        self.results = []
+
+    def run(self, command, rollback=None):
+        """Add a command with an optional command to undo it
+
+        :return: Index of the result of the command
+        """
+        self.steps.append((command, rollback))
+        return len(self.steps) - 1
+
+    def put(self, remote_path, local_fd, mode='0644', rollback=None):
+        """Add writing the contents of the file object to the remote path"""
+        contents = b64encode(local_fd.getvalue()).decode()
+        return self.run(
+            'echo {} | base64 -d | install -m {} /dev/stdin {}'
+            .format(contents, mode, remote_path),
+            rollback,
+        )
+
+    def script(self, marker):
+        # Every step is followed by a line with the marker, its index and
+        # its exit code, so that we can split the output.
+        return '\n'.join(
+            '(\n{}\n) 2>&1; s=$?; echo; echo {} {} $s; [ $s -eq 0 ] || exit $s'
+            .format(command, marker, index)
+            for index, (command, rollback) in enumerate(self.steps)
+        )
+
+    def parse(self, output, marker):
+        self.results = []
+        lines = []
+        for line in output.replace('\r\n', '\n').split('\n'):
+            if line.startswith(marker + ' '):
+                return_code = int(line.split()[2])
+                self.results.append((return_code, '\n'.join(lines).strip()))
+                lines = []
+            else:
+                lines.append(line)
+
+
+def run_batches(batches, transaction=None, silent=False):
+    """Run the batches of multiple hosts at the same time
+
+    Every batch runs on its own channel like run_parallel() does.  Unlike
+    Host.batch(), the commands run directly on the hosts, so this is not
+    meant for mounted VMs.  The rollback commands of the succeeded steps
+    of all batches are registered on the transaction, before the error of
+    the first failed batch is raised.  The batches that could not be run
+    at all have no results.
+
+    :param batches: List of host and batch tuples
+    """
+    marker = 'igvm-batch-{}'.format(uuid4().hex)
+    channels = []
+    for host, batch in batches:
+        with host.fabric_settings():
+            channels.append((
+                host._get_transport(),
+                _get_channel_limit(fabric.api.env.host_string),
+            ))
+
+    with ThreadPoolExecutor(len(batches)) as executor:
+        futures = [
+            executor.submit(
+                _run_on_channel, transport, limit, batch.script(marker),
+                silent, True, warn_only=True,
+            )
+            for (host, batch), (transport, limit) in zip(batches, channels)
+        ]
+        wait(futures)
+
+    # The rollbacks of all batches that ran are needed, even if running
+    # another one failed.
+    error = None
+    for (host, batch), future in zip(batches, futures):
+        try:
+            batch.parse(future.result(), marker)
+            host._finish_batch(batch, transaction)
+        except Exception as exception:
+            error = error or exception
+    if error:
+        raise error
+
+
+def _get_channel_limit(host):
+    with _channel_limits_lock:
+        if host not in _channel_limits:
+            _channel_limits[host] = Semaphore(SSH_MAX_CHANNELS)
+        return _channel_limits[host]
+
+
+def _shell_command(command, with_sudo):
+    shell_command = '/bin/sh -c ' + quote(command)
+    if with_sudo:
+        shell_command = 'sudo -n ' + shell_command
+    return shell_command
+
+
+def _run_on_channel(transport, limit, command, silent, with_sudo,
+                    stdin=None, warn_only=False):
+    shell_command = _shell_command(command, with_sudo)
+
+    with limit:
+        if not silent:
+            log.info('Running "{}"'.format(command))
+        channel = transport.open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(shell_command)
+            if stdin is not None:
+                channel.sendall(stdin)
+                channel.shutdown_write()
+            output = channel.makefile('rb').read()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    output = output.decode(errors='replace').strip()
+    if status != 0 and not warn_only:
+        raise RemoteCommandError('"{}" failed with status {}: {}'.format(
+            command, status, output
+        ))
+    return output
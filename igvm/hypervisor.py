@@ -3,12 +3,22 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import logging
 import math
-from time import sleep
-
-from libvirt import VIR_DOMAIN_SHUTOFF
+from os.path import dirname
+from threading import Lock
+from time import sleep, time
+
+from libvirt import (
+    VIR_DOMAIN_EVENT_DEFINED,
+    VIR_DOMAIN_EVENT_UNDEFINED,
+    VIR_DOMAIN_SHUTOFF,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_VCPU,
+    libvirtError,
+)
 from xml.etree import ElementTree
 
 from igvm.exceptions import (
@@ -18,7 +28,7 @@ from igvm.exceptions import (
     InvalidStateError,
     StorageError,
 )
-from igvm.drbd import DRBD
+from igvm.drbd import DRBD, get_tuning_profile, replicate
 from igvm.host import Host
 from igvm.kvm import (
     DomainProperties,
@@ -27,18 +37,30 @@ from igvm.kvm import (
     set_memory,
     set_vcpus,
 )
-from igvm.libvirt import get_virtconn
+from igvm.libvirt import add_domain_event_handler, get_virtconn
 from igvm.settings import (
+    DOMAIN_STATS_MAX_AGE,
+    GOLDEN_VOLUME_SIZE_GIB,
     HOST_RESERVED_MEMORY,
     VG_NAME,
     RESERVED_DISK,
+    SPARSE_BLOCK_SIZE,
     IGVM_IMAGE_URL,
-    IGVM_IMAGE_MD5_URL,
+    IGVM_IMAGE_SHA256_URL,
+    IMAGE_CACHE_SIZE_GIB,
+    IMAGE_DECOMPRESSORS,
     IMAGE_PATH,
+    IMAGE_RESERVED_DISK_GIB,
+    MIGRATE_CHUNK_SIZE_MIB,
+    MIGRATE_COMPRESSOR,
     MIGRATE_CONFIG,
+    MIGRATE_DECOMPRESSOR,
+    MIGRATE_SNAPSHOT_SIZE,
     KVM_HWMODEL_TO_CPUMODEL,
     VM_OVERHEAD_MEMORY,
 )
+from igvm.transaction import Transaction
+from igvm.transfer import ParallelTransfer, ResumableTransfer
 from igvm.utils import retry_wait_backoff
 
 log = logging.getLogger(__name__)
@@ -60,6 +82,23 @@ class Hypervisor(Host):
         self._storage_pool = None
         self._storage_type = None
 
+        # Index of the domains on the hypervisor keyed by the object_id
+        # part of their names.  It is built on first use and kept current
+        # by our own changes and the libvirt lifecycle events.
+        self._domains = None
+        self._domains_conn = None
+        self._domains_lock = Lock()
+        # Events received while the index is being built
+        self._domain_events = None
+
+        # Index of the volumes on the storage pool keyed the same way.  It
+        # is updated by our own changes and dropped on pool refreshes.
+        self._volumes = None
+
+        # Short-lived snapshot of the resource usage of the domains
+        self._stats = None
+        self._stats_time = None
+
     def get_storage_pool(self):
         # Store per-VM path information
         # We cannot store these in the VM object due to migrations.
@@ -89,20 +128,55 @@ class Hypervisor(Host):
     def get_volume_by_vm(self, vm):
         """Get logical volume information of a VM"""
         domain = self._find_domain(vm)
-        for vol_name in self.get_storage_pool().listVolumes():
-            if (
-                # Match the LV based on the object_id encoded within its name
-                vm.match_uid_name(vol_name) or
-                # XXX: Deprecated matching for LVs w/o an uid_name
-                domain and vol_name == domain.name()
-            ):
-                return self.get_storage_pool().storageVolLookupByName(vol_name)
+        keys = [str(vm.dataset_obj['object_id'])]
+        if domain:
+            keys.append(_domain_key(domain.name()))
+
+        volumes = self._volume_index()
+        for key in keys:
+            for vol_name, volume in sorted(volumes.get(key, {}).items()):
+                if (
+                    # Match the LV based on the object_id encoded within its
+                    # name
+                    vm.match_uid_name(vol_name) or
+                    # XXX: Deprecated matching for LVs w/o an uid_name
+                    domain and vol_name == domain.name()
+                ):
+                    return volume
 
         raise StorageError(
             'No existing storage volume found for VM "{}" on "{}".'
             .format(vm.fqdn, self.fqdn)
         )
 
+    def _volume_index(self):
+        """Return the volume index, build it if necessary"""
+        if self._volumes is None:
+            volumes = {}
+            for volume in self.get_storage_pool().listAllVolumes():
+                name = volume.name()
+                volumes.setdefault(_domain_key(name), {})[name] = volume
+            self._volumes = volumes
+        return self._volumes
+
+    def _index_volume(self, volume):
+        """Add a volume to the index, if it is already built"""
+        if self._volumes is not None:
+            name = volume.name()
+            self._volumes.setdefault(_domain_key(name), {})[name] = volume
+
+    def _delete_volume(self, volume):
+        """Delete a volume and remove it from the index"""
+        name = volume.name()
+        volume.delete()
+        if self._volumes is not None:
+            self._volumes.get(_domain_key(name), {}).pop(name, None)
+
+    def refresh_storage_pool(self):
+        """Refresh the storage pool after changes behind libvirt's back"""
+        self.get_storage_pool().refresh()
+        self._volumes = None
+
     def vm_lv_update_name(self, vm):
         """Update the VMs logical volumes name
 
@@ -123,7 +197,7 @@ class Hypervisor(Host):
                         vm.uid_name
                     )
                 )
-                self.get_storage_pool().refresh()
+                self.refresh_storage_pool()
 
     def vm_mount_path(self, vm):
         """Returns the mount path for a VM or raises HypervisorError if not
@@ -215,14 +289,21 @@ class Hypervisor(Host):
                     .format(*hw_pair)
                 )
 
-        # Enough disk?
+        # Enough disk?  The volume left by an interrupted migration is
+        # reused.
         free_disk_space = self.get_free_disk_size_gib()
         vm_disk_size = float(vm.dataset_obj['disk_size_gib'])
+        if self.get_reusable_volume(vm) is not None:
+            vm_disk_size = 0.0
         if vm_disk_size > free_disk_space:
             raise HypervisorError(
                 'Not enough free space in VG {} to build VM while keeping'
-                ' {} GiB reserved'
-                .format(VG_NAME, RESERVED_DISK[self.get_storage_type()])
+                ' {} GiB reserved and up to {} GiB for the images'
+                .format(
+                    VG_NAME,
+                    RESERVED_DISK[self.get_storage_type()],
+                    IMAGE_RESERVED_DISK_GIB,
+                )
             )
 
         # Proper VLAN?
@@ -236,12 +317,15 @@ class Hypervisor(Host):
         """Creates a VM on the hypervisor."""
         log.info('Defining "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
 
-        self.conn().defineXML(generate_domain_xml(self, vm))
+        domain = self.conn().defineXML(generate_domain_xml(self, vm))
+        self._index_domain(domain)
+        self._stats = None
 
         # Refresh storage pools to register the vm image
         for pool_name in self.conn().listStoragePools():
             pool = self.conn().storagePoolLookupByName(pool_name)
             pool.refresh(0)
+        self._volumes = None
         if transaction:
             transaction.on_rollback(
                 'delete VM', self.undefine_vm, vm, keep_storage=True
@@ -286,6 +370,7 @@ class Hypervisor(Host):
             self.redefine_vm(vm)
         else:
             set_vcpus(self, vm, self._get_domain(vm), num_cpu)
+            self._stats = None
 
         # Validate changes
         # We can't rely on the hypervisor to provide data on VMs all the time.
@@ -330,6 +415,7 @@ class Hypervisor(Host):
         else:
             old_total = vm.meminfo()['MemTotal']
             set_memory(self, vm, self._get_domain(vm))
+            self._stats = None
             vm.dataset_obj.commit()
 
             # Hypervisor might take some time to propagate memory changes,
@@ -362,7 +448,7 @@ class Hypervisor(Host):
             # There is no resize function in version of libvirt
             # available in Debian 9.
             self.run('lvresize {} -L {}g'.format(volume.path(), new_size_gib))
-            self.get_storage_pool().refresh()
+            self.refresh_storage_pool()
         else:
             raise NotImplementedError(
                 'Storage volume resizing is supported only on LVM storage!'
@@ -376,18 +462,210 @@ class Hypervisor(Host):
     def create_vm_storage(self, vm, transaction=None, vol_name=None):
         """Allocate storage for a VM. Returns the disk path."""
         vol_name = vm.uid_name if vol_name is None else vol_name
-        volume_xml = """
-            <volume>
-                <name>{name}</name>
-                <allocation unit="G">{size}</allocation>
-                <capacity unit="G">{size}</capacity>
-            </volume>
-        """.format(
-            name=vol_name,
-            size=vm.dataset_obj['disk_size_gib'],
+        volume = self.get_storage_pool().createXML(
+            _volume_xml(vol_name, vm.dataset_obj['disk_size_gib']), 0
         )
+        self._add_volume(volume, vol_name, transaction)
+
+    def reuse_vm_storage(self, vm):
+        """Allocate storage for a VM, unless it is already allocated
+
+        The storage is not destroyed on rollback, so that it can be reused
+        by the next attempt.  Returns whether it is reused.
+        """
+        volume = self.get_reusable_volume(vm)
+        if volume is not None:
+            log.info('Reusing storage volume {} on {}'.format(
+                volume.name(), self
+            ))
+            return True
 
-        volume = self.get_storage_pool().createXML(volume_xml, 0)
+        try:
+            self._delete_volume(self.get_volume_by_vm(vm))
+        except StorageError:
+            pass
+        self.create_vm_storage(vm)
+        return False
+
+    def get_reusable_volume(self, vm):
+        """Return the existing storage volume of the VM of the right size"""
+        try:
+            volume = self.get_volume_by_vm(vm)
+        except StorageError:
+            return None
+        if volume.info()[1] != vm.dataset_obj['disk_size_gib'] * 1024 ** 3:
+            return None
+        return volume
+
+    @contextmanager
+    def vm_storage_snapshot(self, vm):
+        """Snapshot the storage of a VM, yield the path of the snapshot"""
+        if self.get_storage_type() != 'logical':
+            raise NotImplementedError(
+                'Snapshots are supported only on hypervisors using LVM '
+                'storage!'
+            )
+
+        volume_path = self.get_volume_by_vm(vm).path()
+        # The name must not match the VM, not to be taken as its storage.
+        snapshot_name = 'igvm_snapshot_{}'.format(vm.dataset_obj['object_id'])
+        self.run('lvcreate --snapshot --extents {} --name {} {}'.format(
+            MIGRATE_SNAPSHOT_SIZE, snapshot_name, volume_path
+        ))
+        snapshot_path = '{}/{}'.format(dirname(volume_path), snapshot_name)
+        try:
+            yield snapshot_path
+        finally:
+            self.run('lvremove --force {}'.format(snapshot_path))
+
+    def get_snapshot_changes(self, snapshot_path, granularity):
+        """Return the byte ranges of the origin written since the snapshot
+
+        The exceptions are read from the persistent store of the snapshot.
+        Its metadata areas start with a chunk of pairs of the origin and
+        the store chunk numbers, followed by the chunks of data they list.
+        The ranges are aligned to the granularity.  None is returned, if
+        the snapshot is not valid anymore.
+        """
+        # 0 <sectors> snapshot <allocated>/<total> <metadata sectors>
+        status = self.run(
+            'dmsetup status {}'.format(snapshot_path), silent=True
+        ).split()
+        if len(status) < 5 or '/' not in status[3]:
+            log.warning('Snapshot {} is not valid: {}'.format(
+                snapshot_path, ' '.join(status[3:])
+            ))
+            return None
+
+        # 0 <sectors> snapshot <origin> <store> P <chunk sectors>
+        table = self.run(
+            'dmsetup table {}'.format(snapshot_path), silent=True
+        ).split()
+        store = table[4]
+        chunk_size = int(table[6]) * 512
+        exceptions_per_area = chunk_size // 16
+        # The header chunk is counted with the metadata areas.
+        areas = int(status[4]) * 512 // chunk_size - 1
+
+        output = self.run(
+            'for i in $(seq 0 {areas}) ; do '
+            'dd if=/dev/block/{store} bs={chunk_size} '
+            'skip=$((1 + i * {stride})) count=1 status=none ; '
+            'done | od -A n -v -t u8 --endian=little | '
+            'awk \'{{ for (i = 1; i <= NF; i++) {{ '
+            'if (n++ % 2 == 0) {{ o = $i }} '
+            'else {{ if ($i == 0) exit ; print int(o / {factor}) }} '
+            '}} }}\' | sort -n -u'
+            .format(
+                areas=areas - 1,
+                store=store,
+                chunk_size=chunk_size,
+                stride=exceptions_per_area + 1,
+                factor=max(granularity // chunk_size, 1),
+            ),
+            silent=True,
+        )
+        granularity = max(granularity, chunk_size)
+        return [
+            (int(i) * granularity, granularity) for i in output.split()
+        ]
+
+    def clone_vm_storage(self, vm, image, transaction=None):
+        """Allocate storage for a VM as a copy of the golden volume
+
+        The golden volume of the image is prepared first, if necessary.
+        ZFS volumes are cloned from the snapshot of the golden volume.
+        LVM volumes are copied, because the volume groups are not thin
+        provisioned.  The file system needs to be grown to the disk size
+        of the VM after mounting.
+        """
+        golden = self.get_golden_volume(image)
+        vol_name = vm.uid_name
+        if self.get_storage_type() == 'zfs':
+            golden_dataset = _zfs_dataset(golden)
+            dataset = '{}/{}'.format(
+                golden_dataset.rsplit('/', 1)[0], vol_name
+            )
+            self.run('zfs clone {}@golden {}'.format(golden_dataset, dataset))
+            self.run('zfs set volsize={}G {}'.format(
+                vm.dataset_obj['disk_size_gib'], dataset
+            ))
+            self.refresh_storage_pool()
+            volume = self.get_storage_pool().storageVolLookupByName(vol_name)
+        else:
+            volume = self.get_storage_pool().createXMLFrom(
+                _volume_xml(vol_name, vm.dataset_obj['disk_size_gib']),
+                golden,
+                0,
+            )
+        self._add_volume(volume, vol_name, transaction)
+
+        # The copies would share the UUID of the file system otherwise, and
+        # XFS refuses to mount them at the same time.
+        self.run('xfs_admin -U generate {}'.format(volume.path()))
+
+    def get_golden_volume(self, image):
+        """Return the golden volume of the image, prepare it if necessary
+
+        The golden volume is a formatted volume with the image extracted.
+        It is named after the checksum of the image, so that it is prepared
+        again when the image is updated.  The older ones are deleted then,
+        unless they still have clones.
+        """
+        self.fetch_image(image)
+        checksum = self.run(
+            'basename $(readlink {}/{})'.format(IMAGE_PATH, image),
+            silent=True,
+        ).split('.', 1)[0]
+        prefix = 'golden_{}_'.format(image.split('.', 1)[0])
+        vol_name = prefix + checksum
+
+        volumes = self._volume_index()
+        if vol_name in volumes.get('golden', {}):
+            return volumes['golden'][vol_name]
+
+        for old_name, old_volume in list(volumes.get('golden', {}).items()):
+            if old_name.startswith(prefix):
+                try:
+                    self._delete_volume(old_volume)
+                except libvirtError as error:
+                    log.warning('Cannot delete golden volume {}: {}'.format(
+                        old_name, error
+                    ))
+
+        # The volume is prepared under a different name, so that we would
+        # not use it, if we are interrupted.
+        part_name = 'golden-part_' + vol_name.split('_', 1)[1]
+        if part_name in volumes.get('golden-part', {}):
+            self._delete_volume(volumes['golden-part'][part_name])
+
+        with Transaction() as transaction:
+            volume = self.get_storage_pool().createXML(
+                _volume_xml(part_name, GOLDEN_VOLUME_SIZE_GIB), 0
+            )
+            self._add_volume(volume, part_name, transaction)
+            self.format_storage(volume.path())
+            mount_dir = self.mount_temp(volume.path(), suffix='-' + part_name)
+            try:
+                self.fetch_image(image, mount_dir)
+            finally:
+                self.umount_temp(mount_dir)
+                self.remove_temp(mount_dir)
+
+            if self.get_storage_type() == 'zfs':
+                dataset = _zfs_dataset(volume)
+                golden_dataset = '{}/{}'.format(
+                    dataset.rsplit('/', 1)[0], vol_name
+                )
+                self.run('zfs rename {} {}'.format(dataset, golden_dataset))
+                self.run('zfs snapshot {}@golden'.format(golden_dataset))
+            else:
+                self.run('lvrename {} {}'.format(volume.path(), vol_name))
+        self.refresh_storage_pool()
+
+        return self.get_storage_pool().storageVolLookupByName(vol_name)
+
+    def _add_volume(self, volume, vol_name, transaction=None):
         if volume is None:
             raise StorageError(
                 'Failed to create storage volume {}/{}'.format(
@@ -396,8 +674,11 @@ class Hypervisor(Host):
                 )
             )
 
+        self._index_volume(volume)
         if transaction:
-            transaction.on_rollback('destroy storage', volume.delete)
+            transaction.on_rollback(
+                'destroy storage', self._delete_volume, volume
+            )
 
         # XXX: When building a VM we use the volumes path to format it right
         # after creation.  Unfortunately the kernel is slow to pick up on zfs
@@ -418,28 +699,102 @@ class Hypervisor(Host):
         return self.mount_vm_storage(vm, transaction)
 
     def download_and_extract_image(self, image, target_dir):
-        """Download image, verify its checsum and extract it
+        """Fetch the image to the cache and extract it
 
         All operations must be performed with locking, so that parallel
         running igvm won't touch eachothers' images.
         """
+        self.fetch_image(image, target_dir)
+
+    def fetch_image(self, image, target_dir=None):
+        """Fetch the image to the cache, and extract it if target is given
+
+        The images are stored by their SHA-256 digests with a link from the
+        image name to the last fetched one.  Only the digest is downloaded,
+        if the image is already in the cache.  The cached one is used, if
+        the image server is unavailable.  The least recently used images
+        are evicted when the cache grows over its size.
+
+        The images are downloaded, hashed and extracted in a single pass.
+        The download is only moved to the cache after the digest is
+        confirmed.  It fails otherwise, leaving the target to be rolled
+        back by the caller.
+
+        The images are decompressed with the multithreaded implementations
+        of the format given by their extensions.
+        """
+        img_format = image.split('.', 1)[1]
+        if img_format not in IMAGE_DECOMPRESSORS:
+            raise StorageError(
+                'Unsupported image format "{}"'.format(img_format)
+            )
+
+        if target_dir:
+            # Letting tar run the decompressor makes it fail on the errors
+            # of the decompressor.
+            extract = (
+                'tar --xattrs --xattrs-include=\'*\' -I {decompressor} '
+                '-xf {src} -C {dst_path}'
+            )
+            stream_to = '| ' + extract.replace('{src}', '-')
+        else:
+            extract = 'true'
+            stream_to = '> /dev/null'
+
+        commands = [
+            'set -e',
+            'flock -w 120 9',
+            'mkdir -p {img_path}/by-checksum',
+            'extracted=',
+            'if curl -fsS -o {img_path}/{img_file}.sha256 {sha256_url} ; then '
+            'digest=$(cut -d" " -f1 {img_path}/{img_file}.sha256) ; '
+            'blob={img_path}/by-checksum/$digest.{img_format} ; '
+            'if [ ! -f $blob ] ; then '
+            'rm -f $blob.part $blob.fifo ; '
+            'mkfifo $blob.fifo ; '
+            'sha256sum < $blob.fifo > $blob.sum & '
+            'curl -fsS {img_url} | tee $blob.fifo $blob.part ' + stream_to +
+            ' ; '
+            'wait $! ; '
+            'if [ "$(cut -d" " -f1 $blob.sum)" != "$digest" ] ; then '
+            'rm -f $blob.part $blob.fifo $blob.sum ; '
+            'echo "Digest of {img_file} does not match" >&2 ; exit 1 ; '
+            'fi ; '
+            'rm -f $blob.fifo $blob.sum ; '
+            'mv $blob.part $blob ; '
+            'extracted=1 ; '
+            'fi ; '
+            'ln -sfn by-checksum/$digest.{img_format} {img_path}/{img_file} ; '
+            'elif [ ! -e {img_path}/{img_file} ] ; then '
+            'echo "{img_file} is not available" >&2 ; exit 1 ; '
+            'else '
+            'echo "Using the cached {img_file}" >&2 ; '
+            'fi',
+            '[ -n "$extracted" ] || ' + extract.replace(
+                '{src}', '{img_path}/{img_file}'
+            ),
+            # Touch the image to mark it used, and evict the least
+            # recently used ones when the cache is too big.
+            'touch {img_path}/{img_file}',
+            'for img in $(ls -tr {img_path}/by-checksum/* | head -n -1) ; do '
+            '[ $(du -sm {img_path} | cut -f1) -gt {max_size} ] || break ; '
+            'rm -f $img ; '
+            'done',
+            'find {img_path} -xtype l -delete',
+        ]
 
         self.run(
-            '( '
-            'set -e ; '
-            'flock -w 120 9 ; '
-            'curl -o {img_path}/{img_file}.md5 {md5_url} ; '
-            'sed -Ei \'s_ (.*/)?([a-zA-Z0-9\.\-]+)$_ {img_path}/\\2_\' '
-            '{img_path}/{img_file}.md5 ; '
-            'md5sum -c {img_path}/{img_file}.md5 || '
-            'curl -o {img_path}/{img_file} {img_url} ; '
-            'tar --xattrs --xattrs-include=\'*\' -xzf {img_path}/{img_file} '
-            '-C {dst_path} ;'
-            ') 9>/tmp/igvm_image.lock'.format(
+            (
+                'mkdir -p {img_path} ; ( ' + ' ; '.join(commands) +
+                ' ; ) 9>{img_path}/.lock'
+            ).format(
                 img_path=IMAGE_PATH,
                 img_file=image,
                 img_url=IGVM_IMAGE_URL.format(image=image),
-                md5_url=IGVM_IMAGE_MD5_URL.format(image=image),
+                sha256_url=IGVM_IMAGE_SHA256_URL.format(image=image),
+                img_format=img_format,
+                max_size=IMAGE_CACHE_SIZE_GIB * 1024,
+                decompressor=IMAGE_DECOMPRESSORS[img_format],
                 dst_path=target_dir,
             )
         )
@@ -509,11 +864,23 @@ class Hypervisor(Host):
         It is erroring out when multiple domains found, and returning None,
         when none found.
         """
+        # Candidates are the domains named after the object_id and,
+        # for the deprecated domains w/o an uid_name, the ones named after
+        # any prefix of the hostname.
+        fqdn_parts = vm.fqdn.split('.')
+        keys = {str(vm.dataset_obj['object_id'])}
+        keys.update(
+            _domain_key('.'.join(fqdn_parts[:i]))
+            for i in range(1, len(fqdn_parts) + 1)
+        )
+
         found = None
-        # We are not using lookupByName(), because it prints ugly messages to
-        # the console.
-        for domain in self.conn().listAllDomains():
-            name = domain.name()
+        domains = self._domain_index()
+        with self._domains_lock:
+            candidates = [
+                (n, d) for k in keys for n, d in domains.get(k, {}).items()
+            ]
+        for name, domain in sorted(candidates, key=lambda c: c[0]):
             if not (
                 # Match the domain based on the object_id encoded in its name
                 vm.match_uid_name(name) or
@@ -530,6 +897,73 @@ class Hypervisor(Host):
             found = domain
         return found
 
+    def _domain_index(self):
+        """Return the domain index, build it if necessary
+
+        We are not using lookupByName(), because it prints ugly messages to
+        the console.  Instead, all domains are listed once and the index is
+        updated by ourselves and the libvirt lifecycle events afterwards.
+        The index is rebuilt, if the connection has changed, because
+        the events would be lost with the old one.
+        """
+        conn = self.conn()
+        if self._domains is None or self._domains_conn is not conn:
+            # The events received while listing the domains are applied
+            # afterwards not to lose any.
+            with self._domains_lock:
+                self._domain_events = []
+            add_domain_event_handler(conn, self._domain_event)
+            domains = {}
+            for domain in conn.listAllDomains():
+                name = domain.name()
+                domains.setdefault(_domain_key(name), {})[name] = domain
+            with self._domains_lock:
+                self._domains = domains
+                self._domains_conn = conn
+                for event in self._domain_events:
+                    self._apply_domain_event(*event)
+                self._domain_events = None
+        return self._domains
+
+    def _index_domain(self, domain):
+        """Add a domain to the index, if it is already built"""
+        name = domain.name()
+        with self._domains_lock:
+            if self._domains is not None:
+                self._domains.setdefault(_domain_key(name), {})[name] = domain
+        return domain
+
+    def _unindex_domain(self, name):
+        """Remove a domain from the index, if it is already built"""
+        with self._domains_lock:
+            if self._domains is not None:
+                self._domains.get(_domain_key(name), {}).pop(name, None)
+
+    def _domain_event(self, conn, domain, event, detail):
+        """Keep the domain index current on changes by others
+
+        This is called from the libvirt event loop thread.
+        """
+        if event not in [VIR_DOMAIN_EVENT_DEFINED, VIR_DOMAIN_EVENT_UNDEFINED]:
+            return
+        with self._domains_lock:
+            if self._domain_events is not None:
+                self._domain_events.append((conn, domain, event))
+            else:
+                self._apply_domain_event(conn, domain, event)
+        self._stats = None
+
+    def _apply_domain_event(self, conn, domain, event):
+        # The lock must be held.  The events of the previous connections
+        # are ignored, as the index is built from the current one.
+        if self._domains is None or conn is not self._domains_conn:
+            return
+        name = domain.name()
+        if event == VIR_DOMAIN_EVENT_DEFINED:
+            self._domains.setdefault(_domain_key(name), {})[name] = domain
+        else:
+            self._domains.get(_domain_key(name), {}).pop(name, None)
+
     def _get_domain(self, vm):
         domain = self._find_domain(vm)
         if not domain:
@@ -546,9 +980,15 @@ class Hypervisor(Host):
 
     def migrate_vm(
         self, vm, target_hypervisor, offline, offline_transport, transaction,
-        no_shutdown,
+        no_shutdown, max_bandwidth=None,
     ):
-        if offline_transport not in ['netcat', 'drbd']:
+        """Migrate the VM to the target hypervisor
+
+        The max_bandwidth is in MiB/s.  It is not limited by default.
+        """
+        if offline_transport not in [
+            'netcat', 'sparse', 'parallel', 'resumable', 'precopy', 'drbd'
+        ]:
             raise StorageError(
                 'Unknown offline transport method {}!'
                 .format(offline_transport)
@@ -559,7 +999,16 @@ class Hypervisor(Host):
                 'Starting offline migration of vm {} from {} to {}'.format(
                     vm, vm.hypervisor, target_hypervisor,
             ))
-            target_hypervisor.create_vm_storage(vm, transaction)
+            if offline_transport == 'resumable':
+                resume = target_hypervisor.reuse_vm_storage(vm)
+                transaction.on_rollback(
+                    'keep storage', log.warning,
+                    'Storage of {} is kept on {}, migrate it again with '
+                    'the resumable transport to continue'
+                    .format(vm, target_hypervisor),
+                )
+            else:
+                target_hypervisor.create_vm_storage(vm, transaction)
             if offline_transport == 'drbd':
                 if (
                     self.get_storage_type() != 'logical' or
@@ -570,8 +1019,15 @@ class Hypervisor(Host):
                         ' using LVM storage!'
                     )
 
-                host_drbd = DRBD(self, vm, master_role=True)
-                peer_drbd = DRBD(target_hypervisor, vm)
+                profile = get_tuning_profile(self, target_hypervisor)
+                host_drbd = DRBD(
+                    self, vm, master_role=True, max_rate=max_bandwidth,
+                    profile=profile,
+                )
+                peer_drbd = DRBD(
+                    target_hypervisor, vm, max_rate=max_bandwidth,
+                    profile=profile,
+                )
                 if vm.hypervisor.vm_running(vm):
                     vm_block_size = vm.get_block_size('/dev/vda')
                     src_block_size = vm.hypervisor.get_block_size(
@@ -589,7 +1045,7 @@ class Hypervisor(Host):
                         src_block_size,
                         dst_block_size,
                     ))
-                with host_drbd.start(peer_drbd), peer_drbd.start(host_drbd):
+                with replicate(host_drbd, peer_drbd):
                     # XXX: Do we really need to wait for the both?
                     host_drbd.wait_for_sync()
                     peer_drbd.wait_for_sync()
@@ -605,25 +1061,80 @@ class Hypervisor(Host):
                                 transaction=transaction,
                             )
 
-            elif offline_transport == 'netcat':
-                vm.set_state('maintenance', transaction=transaction)
-                if vm.is_running():
-                    if no_shutdown:
-                        log.info('Please shut down the VM manually now')
-                        vm.wait_for_running(running=False, timeout=86400)
-                    else:
-                        vm.shutdown(
-                            check_vm_up_on_transaction=False,
-                            transaction=transaction,
+            else:
+                vm_disk_path = target_hypervisor.get_volume_by_vm(vm).path()
+                vm_disk_size = vm.dataset_obj['disk_size_gib'] * 1024 ** 3
+                with ExitStack() as stack:
+                    snapshot_path = None
+                    if offline_transport == 'precopy' and vm.is_running():
+                        # Copy the disk while the VM is still running, so that
+                        # only the chunks changed in the meantime need to be
+                        # sent after it is stopped.  The snapshot is kept until
+                        # then to find them.
+                        snapshot_path = stack.enter_context(
+                            self.vm_storage_snapshot(vm)
                         )
+                        ResumableTransfer(
+                            self,
+                            snapshot_path,
+                            target_hypervisor,
+                            vm_disk_path,
+                            vm_disk_size,
+                            max_bandwidth=max_bandwidth,
+                            resume=False,
+                        ).run(cleanup=False)
+                        resume = True
+                    elif offline_transport == 'precopy':
+                        resume = False
 
-                vm_disk_path = target_hypervisor.get_volume_by_vm(vm).path()
-                with target_hypervisor.netcat_to_device(vm_disk_path) as args:
-                    self.device_to_netcat(
-                        self.get_volume_by_vm(vm).path(),
-                        vm.dataset_obj['disk_size_gib'] * 1024 ** 3,
-                        args,
-                    )
+                    vm.set_state('maintenance', transaction=transaction)
+                    if vm.is_running():
+                        if no_shutdown:
+                            log.info('Please shut down the VM manually now')
+                            vm.wait_for_running(running=False, timeout=86400)
+                        else:
+                            vm.shutdown(
+                                check_vm_up_on_transaction=False,
+                                transaction=transaction,
+                            )
+
+                    if offline_transport in ['resumable', 'precopy']:
+                        changes = None
+                        if snapshot_path:
+                            changes = self.get_snapshot_changes(
+                                snapshot_path,
+                                MIGRATE_CHUNK_SIZE_MIB * 1024 ** 2,
+                            )
+                        ResumableTransfer(
+                            self,
+                            self.get_volume_by_vm(vm).path(),
+                            target_hypervisor,
+                            vm_disk_path,
+                            vm_disk_size,
+                            max_bandwidth=max_bandwidth,
+                            resume=resume,
+                        ).run(changes=changes)
+                    elif offline_transport == 'parallel':
+                        ParallelTransfer(
+                            self,
+                            self.get_volume_by_vm(vm).path(),
+                            target_hypervisor,
+                            vm_disk_path,
+                            vm_disk_size,
+                            max_bandwidth=max_bandwidth,
+                        ).run()
+                    else:
+                        sparse = offline_transport == 'sparse'
+                        with target_hypervisor.netcat_to_device(
+                            vm_disk_path, sparse
+                        ) as args:
+                            self.device_to_netcat(
+                                self.get_volume_by_vm(vm).path(),
+                                vm_disk_size,
+                                args,
+                                max_bandwidth,
+                                sparse,
+                            )
             target_hypervisor.define_vm(vm, transaction)
         else:
             # For online migrations always use same volume name as VM
@@ -632,12 +1143,15 @@ class Hypervisor(Host):
                 vm, transaction,
                 vm.hypervisor.get_volume_by_vm(vm).name(),
             )
-            migrate_live(self, target_hypervisor, vm, self._get_domain(vm))
+            migrate_live(
+                self, target_hypervisor, vm, self._get_domain(vm),
+                max_bandwidth,
+            )
 
     def total_vm_memory(self):
         """Get amount of memory in MiB available to hypervisor"""
         # Start with what OS sees as total memory (not installed memory)
-        total_mib = self.conn().getMemoryStats(-1)['total'] // 1024
+        total_mib = self._get_stats()['total_memory'] // 1024
         # Always keep some extra memory free for Hypervisor
         total_mib -= HOST_RESERVED_MEMORY[self.get_storage_type()]
         return total_mib
@@ -649,12 +1163,49 @@ class Hypervisor(Host):
         # Calculate memory used by other VMs.
         # We can not trust conn().getFreeMemory(), sum up memory used by
         # each VM instead
-        used_kib = 0
-        for dom in self.conn().listAllDomains():
-            used_kib += dom.info()[2]
+        used_kib = sum(
+            s['memory'] for s in self._get_stats()['domains'].values()
+        )
         free_mib = total_mib - (used_kib / 1024 - VM_OVERHEAD_MEMORY)
         return free_mib
 
+    def _get_stats(self):
+        """Return a short-lived snapshot of the resource usage
+
+        The statistics of all domains are fetched in a single call to
+        avoid a round-trip for every domain.  The snapshot is shared by
+        the methods checking the resources, and dropped when we change
+        the domains ourselves.  The memory values are in KiB.
+        """
+        # The event thread may drop the snapshot any time, so it must not
+        # be read back from the attribute.
+        stats = self._stats
+        if stats is None or time() - self._stats_time > DOMAIN_STATS_MAX_AGE:
+            conn = self.conn()
+            domains = {}
+            for domain, stats in conn.getAllDomainStats(
+                VIR_DOMAIN_STATS_STATE |
+                VIR_DOMAIN_STATS_BALLOON |
+                VIR_DOMAIN_STATS_VCPU
+            ):
+                if 'balloon.current' in stats:
+                    memory = stats['balloon.current']
+                else:
+                    # Fallback for the domains not reporting the balloon
+                    memory = domain.info()[2]
+                domains[domain.name()] = {
+                    'state': stats['state.state'],
+                    'memory': memory,
+                    'num_cpu': stats.get('vcpu.current', 0),
+                }
+            stats = {
+                'total_memory': conn.getMemoryStats(-1)['total'],
+                'domains': domains,
+            }
+            self._stats_time = time()
+            self._stats = stats
+        return stats
+
     def start_vm(self, vm):
         log.info('Starting "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
         if self._get_domain(vm).create() != 0:
@@ -697,10 +1248,13 @@ class Hypervisor(Host):
         if not keep_storage:
             # XXX: get_volume_by_vm depends on domain names to find legacy
             # domains w/o an uid_name.  The order is therefore important.
-            self.get_volume_by_vm(vm).delete()
+            self._delete_volume(self.get_volume_by_vm(vm))
 
-        if self._get_domain(vm).undefine() != 0:
+        domain = self._get_domain(vm)
+        if domain.undefine() != 0:
             raise HypervisorError('Unable to undefine "{}".'.format(vm.fqdn))
+        self._unindex_domain(domain.name())
+        self._stats = None
 
     def redefine_vm(self, vm, new_fqdn=None):
         # XXX: vm_lv_update_name depends on domain names to find legacy domains
@@ -713,13 +1267,18 @@ class Hypervisor(Host):
         self.define_vm(vm)
 
     def _vm_sync_from_hypervisor(self, vm, result):
-        vm_info = self._get_domain(vm).info()
-
-        mem = int(vm_info[2] / 1024)
+        name = self._get_domain(vm).name()
+        vm_stats = self._get_stats()['domains'].get(name)
+        if vm_stats is None:
+            # The domain was defined after the statistics were fetched.
+            self._stats = None
+            vm_stats = self._get_stats()['domains'][name]
+
+        mem = int(vm_stats['memory'] / 1024)
         if mem > 0:
             result['memory'] = mem
 
-        num_cpu = vm_info[3]
+        num_cpu = vm_stats['num_cpu']
         if num_cpu > 0:
             result['num_cpu'] = num_cpu
 
@@ -729,12 +1288,23 @@ class Hypervisor(Host):
         return props.info()
 
     def get_free_disk_size_gib(self, safe=True):
-        """Return free disk space as float in GiB"""
+        """Return free disk space as float in GiB
+
+        With safe, the reserved space is subtracted.  This includes
+        the space for the golden volumes and the image cache, less
+        the golden volumes already allocated.
+        """
         pool_info = self.get_storage_pool().info()
         # Floor instead of ceil because we check free instead of used space
         vg_size_gib = math.floor(float(pool_info[3]) / 1024 ** 3)
         if safe is True:
             vg_size_gib -= RESERVED_DISK[self.get_storage_type()]
+            vg_size_gib -= max(
+                IMAGE_RESERVED_DISK_GIB -
+                len(self._volume_index().get('golden', {})) *
+                GOLDEN_VOLUME_SIZE_GIB,
+                0,
+            )
         return vg_size_gib
 
     def mount_temp(self, device, suffix=''):
@@ -790,17 +1360,43 @@ class Hypervisor(Host):
         self.run('pkill -f "^/bin/nc.traditional -l -p {}"'.format(port))
 
     @contextmanager
-    def netcat_to_device(self, device):
+    def netcat_to_device(self, device, sparse=False):
+        """Receive the device from device_to_netcat()
+
+        With sparse, the stream is decompressed, and the blocks of zeros
+        are skipped instead of written.  The device is zeroed beforehand
+        on LVM, because its blocks are not guaranteed to read as zeros
+        otherwise.  When the device cannot offload writing zeros, all
+        blocks are written instead, as zeroing it would take as long.
+        """
         dev_minor = self.run('stat -L -c "%T" {}'.format(device), silent=True)
         dev_minor = int(dev_minor, 16)
         port = 7000 + dev_minor
 
         self.check_netcat(port)
 
+        skip_zeros = sparse
+        if sparse and self.get_storage_type() == 'logical':
+            if self._get_write_zeroes_max_bytes(device):
+                self.run('blkdiscard -z {}'.format(device))
+            else:
+                log.info(
+                    'Writing all blocks of {}, as it cannot write zeros '
+                    'efficiently'.format(device)
+                )
+                skip_zeros = False
+
         # Using DD lowers load on device with big enough Block Size
         self.run(
-            'nohup /bin/nc.traditional -l -p {0} | dd of={1} obs=1048576 &'
-            .format(port, device)
+            'nohup /bin/nc.traditional -l -p {0} | {1}'
+            'dd of={2} obs={3}{4} &'
+            .format(
+                port,
+                MIGRATE_DECOMPRESSOR + ' | ' if sparse else '',
+                device,
+                SPARSE_BLOCK_SIZE if sparse else 1048576,
+                ' conv=sparse' if skip_zeros else '',
+            )
         )
         try:
             yield self.fqdn, port
@@ -808,10 +1404,56 @@ class Hypervisor(Host):
             self.kill_netcat(port)
             raise
 
-    def device_to_netcat(self, device, size, listener):
+    def _get_write_zeroes_max_bytes(self, device):
+        """Return the size the device can zero in one request, 0 for none"""
+        output = self.run(
+            'cat /sys/block/$(basename $(readlink -f {}))'
+            '/queue/write_zeroes_max_bytes 2> /dev/null || echo 0'
+            .format(device),
+            silent=True,
+        )
+        return int(output)
+
+    def device_to_netcat(self, device, size, listener, max_bandwidth=None,
+                         sparse=False):
+        """Send the device to netcat_to_device()
+
+        With sparse, the stream is compressed.  The bandwidth limit applies
+        to the data read from the device then.
+        """
         # Using DD lowers load on device with big enough Block Size
         self.run(
-            'dd if={0} ibs=1048576 | pv -f -s {1} '
-            '| /bin/nc.traditional -q 1 {2} {3}'
-            .format(device, size, *listener)
+            'dd if={0} ibs=1048576 | pv -f -s {1}{2} '
+            '| {3}/bin/nc.traditional -q 1 {4} {5}'
+            .format(
+                device,
+                size,
+                ' -L {}m'.format(max_bandwidth) if max_bandwidth else '',
+                MIGRATE_COMPRESSOR + ' | ' if sparse else '',
+                *listener
+            )
         )
+
+
+def _domain_key(name):
+    """Return the key of a domain name on the domain index
+
+    This is the object_id part for domains with an uid_name, and the whole
+    name for most of the deprecated ones.
+    """
+    return name.split('_', 1)[0]
+
+
+def _volume_xml(name, size_gib):
+    return """
+        <volume>
+            <name>{name}</name>
+            <allocation unit="G">{size}</allocation>
+            <capacity unit="G">{size}</capacity>
+        </volume>
+    """.format(name=name, size=size_gib)
+
+
+def _zfs_dataset(volume):
+    """Return the ZFS dataset of the volume from its /dev/zvol path"""
+    return volume.path().split('/', 3)[3]
@@ -13,6 +13,7 @@ Copyright (c) 2018 InnoGames GmbH
 # so simple that they could as well just be a function, but kept as classes
 # to have a consistent style.
 
+from collections import Counter
 from logging import getLogger
 
 from igvm.utils import LazyCompare
@@ -20,15 +21,71 @@ from igvm.utils import LazyCompare
 log = getLogger(__name__)
 
 
+class HypervisorTallies(object):
+    """Totals of the attributes of the VMs on the hypervisors
+
+    The totals, and the counts of the VMs by the values of the attributes,
+    are computed once for every hypervisor when they are first needed,
+    and shared by the preferences.  They can be updated when a VM is added
+    to or removed from a hypervisor instead of being computed again.
+    """
+    def __init__(self):
+        self._totals = {}
+        self._counts = {}
+        self._hostnames = {}
+
+    def total(self, hv, attribute):
+        totals = self._totals.setdefault(hv, {})
+        if attribute not in totals:
+            totals[attribute] = sum(
+                v[attribute] for v in hv.dataset_obj['vms']
+            )
+        return totals[attribute]
+
+    def count(self, hv, attributes, vm_obj):
+        """Count the other VMs on the hypervisor with the same attributes"""
+        counts = self._counts.setdefault(hv, {})
+        attributes = tuple(attributes)
+        if attributes not in counts:
+            counts[attributes] = Counter(
+                _project(v, attributes) for v in hv.dataset_obj['vms']
+            )
+        if hv not in self._hostnames:
+            self._hostnames[hv] = {
+                v['hostname'] for v in hv.dataset_obj['vms']
+            }
+
+        result = counts[attributes][_project(vm_obj, attributes)]
+        if vm_obj['hostname'] in self._hostnames[hv]:
+            result -= 1
+        return result
+
+    def add(self, hv, vm_obj):
+        for attribute in self._totals.get(hv, ()):
+            self._totals[hv][attribute] += vm_obj[attribute]
+        for attributes, counter in self._counts.get(hv, {}).items():
+            counter[_project(vm_obj, attributes)] += 1
+        if hv in self._hostnames:
+            self._hostnames[hv].add(vm_obj['hostname'])
+
+    def remove(self, hv, vm_obj):
+        for attribute in self._totals.get(hv, ()):
+            self._totals[hv][attribute] -= vm_obj[attribute]
+        for attributes, counter in self._counts.get(hv, {}).items():
+            counter[_project(vm_obj, attributes)] -= 1
+        if hv in self._hostnames:
+            self._hostnames[hv].discard(vm_obj['hostname'])
+
+
 class InsufficientResource(object):
     """Check a resource of hypervisor would be sufficient"""
     def __init__(self, attribute, reserved=0):
         self.attribute = attribute
         self.reserved = reserved
 
-    def __call__(self, vm, hv):
+    def __call__(self, vm, hv, tallies):
         total_size = hv.dataset_obj[self.attribute]
-        vms_size = sum(v[self.attribute] for v in hv.dataset_obj['vms'])
+        vms_size = tallies.total(hv, self.attribute)
         remaining_size = total_size - vms_size - self.reserved
 
         return remaining_size < vm.dataset_obj[self.attribute]
@@ -41,23 +98,14 @@ class OtherVMs(object):
         self.attributes = attributes
         self.values = values
 
-    def __call__(self, vm, hv):
-        result = 0
-        for other_vm in hv.dataset_obj['vms']:
-            if other_vm['hostname'] == vm.dataset_obj['hostname']:
-                continue
-            if self.values and not all(
-                vm.dataset_obj[a] == v
-                for a, v in zip(self.attributes, self.values)
-            ):
-                continue
-            if all(
-                other_vm[a] == vm.dataset_obj[a]
-                for a in self.attributes
-            ):
-                result += 1
+    def __call__(self, vm, hv, tallies):
+        if self.values and not all(
+            vm.dataset_obj[a] == v
+            for a, v in zip(self.attributes, self.values)
+        ):
+            return 0
 
-        return result
+        return tallies.count(hv, self.attributes, vm.dataset_obj)
 
 
 class HypervisorAttributeValue(object):
@@ -71,7 +119,7 @@ class HypervisorAttributeValue(object):
     def __init__(self, attribute):
         self.attribute = attribute
 
-    def __call__(self, vm, hv):
+    def __call__(self, vm, hv, tallies):
         value = hv.dataset_obj[self.attribute]
 
         return value is not None, value
@@ -89,7 +137,7 @@ class HypervisorAttributeValueLimit(object):
         self.attribute = attribute
         self.limit = limit
 
-    def __call__(self, vm, hv):
+    def __call__(self, vm, hv, tallies):
         value = hv.dataset_obj[self.attribute]
 
         return value is not None and value > self.limit
@@ -100,19 +148,18 @@ class OverAllocation(object):
     def __init__(self, attribute):
         self.attribute = attribute
 
-    def __call__(self, vm, hv):
+    def __call__(self, vm, hv, tallies):
         # New VM has no hypervisor attribute yet.
         if not vm.hypervisor:
             return False
 
-        cur_hv_cpus = sum(
-            v[self.attribute] for v in vm.hypervisor.dataset_obj['vms']
-        )
+        cur_hv_cpus = tallies.total(vm.hypervisor, self.attribute)
         cur_hv_rl_cpus = vm.hypervisor.dataset_obj[self.attribute]
         cur_ovr_allc = float(cur_hv_cpus) / float(cur_hv_rl_cpus)
 
-        tgt_hv_cpus = vm.dataset_obj[self.attribute] + sum(
-            v[self.attribute] for v in hv.dataset_obj['vms']
+        tgt_hv_cpus = (
+            vm.dataset_obj[self.attribute] +
+            tallies.total(hv, self.attribute)
         )
         tgt_hv_rl_cpus = hv.dataset_obj[self.attribute]
         tgt_ovr_allc = float(tgt_hv_cpus) / float(tgt_hv_rl_cpus)
@@ -122,11 +169,11 @@ class OverAllocation(object):
 
 class HashDifference(object):
     """Return some arbitrary number to have stable ordering"""
-    def __call__(self, vm, hv):
+    def __call__(self, vm, hv, tallies):
         return hash(hv.fqdn) - hash(vm.fqdn)
 
 
-def sorted_hypervisors(preferences, vm, hypervisors):
+def sorted_hypervisors(preferences, vm, hypervisors, tallies=None):
     """Sort the hypervisor by their preference
 
     The most preferred ones will be yielded first.  The caller may then verify
@@ -148,12 +195,19 @@ def sorted_hypervisors(preferences, vm, hypervisors):
     which preferences are actually executed for the selected hypervisor,
     and log which preference caused this hypervisor to be sorted after
     the previous or before the next one.
+
+    The totals of the VMs on the hypervisors are shared by the preferences,
+    so that they are summed up only once.  The caller may pass its own
+    HypervisorTallies to share them between the calls.
     """
     log.debug('Sorting hypervisors by preference...')
 
+    if tallies is None:
+        tallies = HypervisorTallies()
+
     # Use decorate-sort-undecorate pattern to log details about sorting
     for comparables, hypervisor in sorted(
-        ([LazyCompare(p, vm, h) for p in preferences], h)
+        ([LazyCompare(p, vm, h, tallies) for p in preferences], h)
         for h in hypervisors
     ):
         for executed, comparable in enumerate(comparables):
@@ -167,3 +221,7 @@ def sorted_hypervisors(preferences, vm, hypervisors):
         )
 
         yield hypervisor
+
+
+def _project(vm_obj, attributes):
+    return tuple(vm_obj[a] for a in attributes)
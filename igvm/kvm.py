@@ -22,15 +22,19 @@ from libvirt import (
     VIR_MIGRATE_NON_SHARED_DISK,
     VIR_MIGRATE_AUTO_CONVERGE,
     VIR_MIGRATE_ABORT_ON_ERROR,
+    VIR_MIGRATE_POSTCOPY,
+    VIR_MIGRATE_PARAM_BANDWIDTH,
     VIR_ERR_OPERATION_ABORTED,
     libvirtError,
     virGetLastError,
 )
 
 from igvm.exceptions import HypervisorError, MigrationError, MigrationAborted
+from igvm.migration import LiveMigrationMonitor
 from igvm.settings import (
     KVM_DEFAULT_MAX_CPUS,
     KVM_HWMODEL_TO_CPUMODEL,
+    LIVE_MIGRATION_POLICIES,
     MAC_ADDRESS_PREFIX,
     VG_NAME,
     MIGRATE_CONFIG,
@@ -238,8 +242,11 @@ def migrate_background(
         raise MigrationError(e)
 
 
-def migrate_live(source, destination, vm, domain):
-    """Live-migrates a VM via libvirt."""
+def migrate_live(source, destination, vm, domain, max_bandwidth=None):
+    """Live-migrates a VM via libvirt.
+
+    The max_bandwidth is in MiB/s.  It is not limited by default.
+    """
 
     # Reduce CPU pinning to minimum number of available cores on both
     # hypervisors to avoid "invalid cpuset" errors.
@@ -259,8 +266,14 @@ def migrate_live(source, destination, vm, domain):
         VIR_MIGRATE_ABORT_ON_ERROR # Don't tolerate soft errors
     )
 
+    # Post-copy must be enabled at the start to switch to it later.
+    if 'postcopy' in LIVE_MIGRATION_POLICIES:
+        migrate_flags |= VIR_MIGRATE_POSTCOPY
+
     migrate_params = {
     }
+    if max_bandwidth:
+        migrate_params[VIR_MIGRATE_PARAM_BANDWIDTH] = max_bandwidth
 
     # Append OS-specific migration commands.  They might not exist for some
     # combinations but this should have already been checked by the caller.
@@ -279,6 +292,9 @@ def migrate_live(source, destination, vm, domain):
         migrate_params, migrate_flags,
     )
 
+    monitor = LiveMigrationMonitor(
+        domain, vm, source, destination, max_bandwidth
+    )
     try:
         while future.running():
             try:
@@ -286,35 +302,39 @@ def migrate_live(source, destination, vm, domain):
             except libvirtError:
                 # When migration is finished, jobStats will fail
                 break
-            if 'memory_total' in js and 'disk_total' in js:
-                log.info(
-                    (
-                        'Migration progress: '
-                        'disk {:.0f}% {:.0f}/{:.0f}MiB, '
-                        'memory {:.0f}% {:.0f}/{:.0f}MiB, '
-                    ).format(
-                        js['disk_processed'] / (js['disk_total']+1) * 100,
-                        js['disk_processed']/1024/1024,
-                        js['disk_total']/1024/1024,
-                        js['memory_processed'] / (js['memory_total']+1) * 100,
-                        js['memory_processed']/1024/1024,
-                        js['memory_total']/1024/1024,
-                    ))
+            if 'memory_total' in js:
+                monitor.update(js)
             else:
                 log.info('Waiting for migration stats to show up')
             time.sleep(1)
     except KeyboardInterrupt:
         domain.abortJob()
         log.info('Awaiting migration to abort')
+        monitor.finish('interrupted')
         future.result()
         # Nothing to log, the function above raised an exception
     else:
         log.info('Awaiting migration to finish')
-        future.result() # Exception from slave thread will re-raise here
+        try:
+            future.result() # Exception from slave thread will re-raise here
+        except MigrationAborted:
+            monitor.finish('aborted')
+            if monitor.abort_reason:
+                raise MigrationError(monitor.abort_reason)
+            raise
+        except MigrationError:
+            monitor.finish('failed')
+            raise
+        monitor.finish('finished')
         log.info('Migration finished')
-        
+
+        # The domain is persisted on the destination by the migration.  We
+        # need to look it up there once to keep its domain index current.
+        domain = destination._index_domain(
+            destination.conn().lookupByName(domain.name())
+        )
+
         # And pin again, in case we migrated to a host with more physical cores
-        domain = destination._get_domain(vm)
         _live_repin_cpus(domain, props, destination.dataset_obj['num_cpu'])
 
 
@@ -3,39 +3,153 @@
 Copyright (c) 2018 InnoGames GmbH
 """
 
-from libvirt import open as libvirt_open, libvirtError
+from libvirt import (
+    open as libvirt_open,
+    libvirtError,
+    virEventRegisterDefaultImpl,
+    virEventRunDefaultImpl,
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+)
+from functools import lru_cache
+from logging import getLogger
 from os import path, environ
+from threading import Lock, Thread
+from weakref import WeakMethod
 
+from igvm.settings import LIBVIRT_KEEPALIVE_COUNT, LIBVIRT_KEEPALIVE_INTERVAL
 from igvm.utils import get_ssh_config
 
+log = getLogger(__name__)
+
 _conns = {}
+_conns_lock = Lock()
+# Locks of the connections by the hypervisors
+_conn_locks = {}
+_event_loop = None
+# Handlers of the domain lifecycle events by the connections
+_domain_event_handlers = {}
+_domain_event_handlers_lock = Lock()
 
 
-def get_virtconn(fqdn):
-    if 'IGVM_SSH_USER' in environ:
-        username = environ.get('IGVM_SSH_USER') + '@'
-    else:
-        ssh_config = get_ssh_config(fqdn)
-        if 'user' in ssh_config:
-            username = ssh_config['user'] + '@'
-        else:
-            username = ''
-
-    scripts_dir = path.join(path.dirname(__file__), 'scripts')
-
-    if fqdn not in _conns:
-        url = 'qemu+ssh://{}{}/system?command={}/ssh_wrapper'.format(
-            username, fqdn, scripts_dir
+def _run_event_loop():
+    while True:
+        virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    """Start the libvirt event loop in a background thread
+
+    Domain events are only delivered when an event loop implementation
+    is registered before the connection is opened.
+    """
+    global _event_loop
+
+    if _event_loop is None:
+        virEventRegisterDefaultImpl()
+        _event_loop = Thread(
+            target=_run_event_loop,
+            name='libvirt-event-loop',
+            daemon=True,
         )
-        _conns[fqdn] = libvirt_open(url)
-    return _conns[fqdn]
+        _event_loop.start()
+
+
+def get_virtconn(fqdn):
+    """Return a live connection to the hypervisor
+
+    The connections are reused by all threads.  The dead ones are closed
+    and opened again.  The connections to different hypervisors are opened
+    at the same time, only the ones to the same hypervisor wait for each
+    other.
+    """
+    with _conns_lock:
+        start_event_loop()
+        lock = _conn_locks.setdefault(fqdn, Lock())
+
+    with lock:
+        conn = _conns.get(fqdn)
+        if conn is not None and not _is_alive(conn):
+            log.warning('Reconnecting to the dead libvirt on {}'.format(fqdn))
+            _close(conn)
+            conn = None
+        if conn is None:
+            conn = libvirt_open(
+                'qemu+ssh://{}{}/system?command={}/ssh_wrapper'.format(
+                    _get_ssh_user(fqdn),
+                    fqdn,
+                    path.join(path.dirname(__file__), 'scripts'),
+                )
+            )
+            conn.setKeepAlive(
+                LIBVIRT_KEEPALIVE_INTERVAL, LIBVIRT_KEEPALIVE_COUNT
+            )
+            with _conns_lock:
+                _conns[fqdn] = conn
+        return conn
+
+
+def add_domain_event_handler(conn, handler):
+    """Call the method on the lifecycle events of the domains
+
+    A single callback is registered on every connection, and dispatches
+    the events to the handlers.  The handlers are referenced weakly, so
+    that they do not keep their objects alive.  They are called from
+    the event loop thread with the connection, the domain, the event and
+    the detail.
+    """
+    ref = WeakMethod(handler)
+    with _domain_event_handlers_lock:
+        handlers = _domain_event_handlers.get(conn)
+        if handlers is None:
+            handlers = _domain_event_handlers[conn] = []
+            conn.domainEventRegisterAny(
+                None,
+                VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                _dispatch_domain_event,
+                handlers,
+            )
+        if ref not in handlers:
+            handlers.append(ref)
+
+
+def _dispatch_domain_event(conn, domain, event, detail, handlers):
+    with _domain_event_handlers_lock:
+        handlers[:] = [r for r in handlers if r() is not None]
+        methods = [r() for r in handlers]
+    for method in methods:
+        if method is not None:
+            method(conn, domain, event, detail)
 
 
 def close_virtconns():
-    for fqdn in list(_conns.keys()):
-        conn = _conns[fqdn]
-        try:
-            conn.close()
-        except libvirtError:
-            pass
-        del _conns[fqdn]
+    with _conns_lock:
+        for fqdn in list(_conns.keys()):
+            _close(_conns.pop(fqdn))
+
+
+def _is_alive(conn):
+    try:
+        return conn.isAlive() == 1
+    except libvirtError:
+        return False
+
+
+def _close(conn):
+    with _domain_event_handlers_lock:
+        _domain_event_handlers.pop(conn, None)
+    try:
+        conn.close()
+    except libvirtError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _get_ssh_user(fqdn):
+    if 'IGVM_SSH_USER' in environ:
+        return environ.get('IGVM_SSH_USER') + '@'
+
+    ssh_config = get_ssh_config(fqdn)
+    if 'user' in ssh_config:
+        return ssh_config['user'] + '@'
+
+    return ''
@@ -0,0 +1,281 @@
+"""igvm - Live Migration Monitor
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from json import dumps
+from logging import getLogger
+from time import time
+
+from libvirt import libvirtError
+
+from igvm.settings import (
+    LIVE_MIGRATION_MAX_DOWNTIME_MS,
+    LIVE_MIGRATION_MAX_SPEED,
+    LIVE_MIGRATION_POLICIES,
+    LIVE_MIGRATION_RECORD_PATH,
+    LIVE_MIGRATION_STALL_TIME,
+    MIGRATE_PROGRESS_INTERVAL,
+)
+
+log = getLogger(__name__)
+
+# Default maximum downtime of QEMU in milliseconds
+DEFAULT_MAX_DOWNTIME_MS = 300
+
+
+class LiveMigrationMonitor(object):
+    """Watch a live migration for converging
+
+    The job statistics of the domain are passed to update() periodically.
+    The dirty page rate is compared with the transfer rate to estimate
+    the remaining time.  The migration is considered not converging, when
+    the remaining memory has not reached a new low for the stall time.
+    The policies are applied one after the other then, until one of them
+    has an effect.  Every sample and every action is appended as a JSON
+    line to the record file, if there is one.
+    """
+    def __init__(self, domain, vm, source, destination, max_bandwidth=None,
+                 policies=LIVE_MIGRATION_POLICIES,
+                 record_path=LIVE_MIGRATION_RECORD_PATH):
+        self.domain = domain
+        self.vm = vm
+        self.source = source
+        self.destination = destination
+        self.speed = max_bandwidth
+        self.policies = list(policies)
+        self.record_path = record_path
+
+        try:
+            self.downtime = domain.migrateGetMaxDowntime(0)
+        except (AttributeError, libvirtError):
+            # Getting it is only supported since libvirt 3.7.
+            self.downtime = DEFAULT_MAX_DOWNTIME_MS
+        self.postcopy = False
+        self.abort_reason = None
+
+        self._last_sample = None
+        self._lowest_remaining = None
+        self._lowest_time = None
+        self._last_log = 0
+
+    def update(self, stats):
+        """Analyse the job statistics of the domain"""
+        now = time()
+        record = self._analyse(stats, now)
+        self._record(record)
+
+        if now - self._last_log >= MIGRATE_PROGRESS_INTERVAL:
+            self._last_log = now
+            log.info(
+                'Migration progress: {phase}, disk {disk_done:.0f}%, '
+                'memory {memory_done:.0f}%, {memory_remaining_mib:.0f} MiB '
+                'remaining, transfer {transfer_rate_mib:.0f} MiB/s, '
+                'dirty {dirty_rate_mib:.0f} MiB/s, iteration {iteration}, '
+                'ETA {eta}'
+                .format(**dict(
+                    record,
+                    eta=(
+                        '{:.0f} s'.format(record['eta'])
+                        if record['eta'] is not None else 'unknown'
+                    ),
+                ))
+            )
+
+        if (
+            record['phase'] == 'memory' and
+            self.policies and
+            self._stalled(record, now)
+        ):
+            self._apply_policy(record)
+            # Give the policy the stall time to have an effect.
+            self._lowest_remaining = record['memory_remaining']
+            self._lowest_time = now
+
+    def finish(self, result):
+        self._record({
+            'event': 'finish',
+            'time': time(),
+            'vm': self.vm.fqdn,
+            'result': result,
+            'abort_reason': self.abort_reason,
+        })
+
+    def _analyse(self, stats, now):
+        memory_remaining = stats.get('memory_remaining', 0)
+        disk_remaining = stats.get('disk_remaining', 0)
+        dirty_rate = (
+            stats.get('memory_dirty_rate', 0) *
+            stats.get('memory_page_size', 4096)
+        )
+        transfer_rate = stats.get('memory_bps')
+        if transfer_rate is None and self._last_sample:
+            last_time, last_processed = self._last_sample
+            transfer_rate = (
+                (stats.get('memory_processed', 0) - last_processed) /
+                max(now - last_time, 1)
+            )
+        self._last_sample = (now, stats.get('memory_processed', 0))
+        transfer_rate = transfer_rate or 0
+
+        # The memory converges by the difference of the rates.
+        eta = None
+        if self.postcopy:
+            if transfer_rate > 0:
+                eta = memory_remaining / transfer_rate
+        elif transfer_rate > dirty_rate:
+            eta = (
+                stats.get('data_remaining', memory_remaining) /
+                (transfer_rate - dirty_rate)
+            )
+
+        return {
+            'event': 'sample',
+            'time': now,
+            'vm': self.vm.fqdn,
+            'source': self.source.fqdn,
+            'destination': self.destination.fqdn,
+            'elapsed': stats.get('time_elapsed', 0) / 1000.0,
+            'phase': (
+                'postcopy' if self.postcopy else
+                'disk' if disk_remaining else 'memory'
+            ),
+            'disk_done': _percent(stats, 'disk'),
+            'memory_done': _percent(stats, 'memory'),
+            'memory_remaining': memory_remaining,
+            'memory_remaining_mib': memory_remaining / 1024.0 ** 2,
+            'disk_remaining': disk_remaining,
+            'transfer_rate': transfer_rate,
+            'transfer_rate_mib': transfer_rate / 1024.0 ** 2,
+            'dirty_rate': dirty_rate,
+            'dirty_rate_mib': dirty_rate / 1024.0 ** 2,
+            'iteration': stats.get('memory_iteration', 0),
+            'throttle': stats.get('auto_converge_throttle', 0),
+            'eta': eta,
+            'max_downtime_ms': self.downtime,
+            'max_speed_mib': self.speed,
+        }
+
+    def _stalled(self, record, now):
+        remaining = record['memory_remaining']
+        if (
+            self._lowest_remaining is None or
+            remaining < self._lowest_remaining
+        ):
+            self._lowest_remaining = remaining
+            self._lowest_time = now
+            return False
+        return now - self._lowest_time >= LIVE_MIGRATION_STALL_TIME
+
+    def _apply_policy(self, record):
+        """Apply the first policy that has an effect"""
+        log.warning(
+            'Migration of {} is not converging, {:.0f} MiB remaining, '
+            'dirty {:.0f} MiB/s, transfer {:.0f} MiB/s'
+            .format(
+                self.vm,
+                record['memory_remaining_mib'],
+                record['dirty_rate_mib'],
+                record['transfer_rate_mib'],
+            )
+        )
+        while self.policies:
+            policy = self.policies[0]
+            try:
+                value = getattr(self, '_apply_' + policy)(record)
+            except libvirtError as error:
+                # The job may finish any time, the policies are not needed
+                # anymore then.
+                log.info('Cannot apply {} policy to {}: {}'.format(
+                    policy, self.vm, error
+                ))
+                self.policies = []
+                return
+            if value is not None:
+                self._record({
+                    'event': 'policy',
+                    'time': time(),
+                    'vm': self.vm.fqdn,
+                    'policy': policy,
+                    'value': value,
+                })
+                return
+            self.policies.pop(0)
+
+    def _apply_downtime(self, record):
+        if self.downtime >= LIVE_MIGRATION_MAX_DOWNTIME_MS:
+            return None
+
+        # Allow the downtime it would take to send the remaining memory
+        downtime = self.downtime * 2
+        if record['transfer_rate']:
+            downtime = max(downtime, int(
+                record['memory_remaining'] / record['transfer_rate'] * 1000
+            ))
+        self.downtime = min(downtime, LIVE_MIGRATION_MAX_DOWNTIME_MS)
+        log.info('Raising maximum downtime of {} to {} ms'.format(
+            self.vm, self.downtime
+        ))
+        self.domain.migrateSetMaxDowntime(self.downtime, 0)
+        return self.downtime
+
+    def _apply_speed(self, record):
+        # The speed is not limited without the bandwidth limit.
+        if (
+            not self.speed or
+            not LIVE_MIGRATION_MAX_SPEED or
+            self.speed >= LIVE_MIGRATION_MAX_SPEED
+        ):
+            return None
+
+        self.speed = min(self.speed * 2, LIVE_MIGRATION_MAX_SPEED)
+        log.info('Raising maximum speed of {} to {} MiB/s'.format(
+            self.vm, self.speed
+        ))
+        self.domain.migrateSetMaxSpeed(self.speed, 0)
+        return self.speed
+
+    def _apply_postcopy(self, record):
+        log.info('Switching migration of {} to post-copy'.format(self.vm))
+        self.domain.migrateStartPostCopy(0)
+        self.postcopy = True
+        # The migration cannot be aborted after switching to post-copy.
+        self.policies = []
+        return True
+
+    def _apply_abort(self, record):
+        reason = (
+            'Migration of {} did not converge with {:.0f} MiB remaining, '
+            'dirty {:.0f} MiB/s, transfer {:.0f} MiB/s'
+            .format(
+                self.vm,
+                record['memory_remaining_mib'],
+                record['dirty_rate_mib'],
+                record['transfer_rate_mib'],
+            )
+        )
+        log.error(reason)
+        self.domain.abortJob()
+        self.abort_reason = reason
+        self.policies = []
+        return True
+
+    def _record(self, record):
+        if not self.record_path:
+            return
+        try:
+            with open(self.record_path, 'a') as fd:
+                fd.write(dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as error:
+            # The records must not fail the migration.
+            log.warning('Cannot write migration records to {}: {}'.format(
+                self.record_path, error
+            ))
+            self.record_path = None
+
+
+def _percent(stats, kind):
+    total = stats.get(kind + '_total')
+    if not total:
+        return 100.0
+    return 100.0 * stats.get(kind + '_processed', 0) / total
@@ -0,0 +1,136 @@
+"""igvm - Placement Planner
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+import json
+import logging
+
+from igvm.hypervisor_preferences import (
+    HypervisorTallies,
+    InsufficientResource,
+    sorted_hypervisors,
+)
+from igvm.settings import HYPERVISOR_PREFERENCES
+
+log = logging.getLogger(__name__)
+
+
+class PlacementPlanner(object):
+    """Assign multiple VMs to hypervisors at once
+
+    The planner works on the Serveradmin data of the hypervisors queried
+    once.  The VMs assigned to a hypervisor are added to its VMs, and
+    removed from their current one, so that the preferences account for
+    the earlier decisions.  The resources of the hypervisors are tallied
+    incrementally to check whether a VM would fit without summing up all
+    of their VMs again.
+    """
+    def __init__(self, hypervisors):
+        self.hypervisors = list(hypervisors)
+        self._by_fqdn = {h.fqdn: h for h in self.hypervisors}
+        self._checks = [
+            p for p in HYPERVISOR_PREFERENCES
+            if isinstance(p, InsufficientResource)
+        ]
+        self._tallies = HypervisorTallies()
+
+    def get_hypervisor(self, hostname):
+        return self._by_fqdn.get(hostname)
+
+    def fits(self, vm, hypervisor):
+        """Check the resources of the hypervisor would be sufficient"""
+        return not any(c(vm, hypervisor, self._tallies) for c in self._checks)
+
+    def choose(self, vm, exclude=()):
+        """Return the most preferred hypervisor the VM fits or None"""
+        candidates = [
+            h for h in self.hypervisors
+            if (
+                h != vm.hypervisor and
+                h not in exclude and
+                h.get_vlan_network(vm.dataset_obj['intern_ip']) and
+                self.fits(vm, h)
+            )
+        ]
+        for hypervisor in sorted_hypervisors(
+            HYPERVISOR_PREFERENCES, vm, candidates, self._tallies
+        ):
+            return hypervisor
+        return None
+
+    def assign(self, vm, hypervisor):
+        """Move the VM to the hypervisor in the plan"""
+        source = self.get_hypervisor(vm.hypervisor.fqdn)
+        if source is not None:
+            self._remove(source, vm)
+        self._add(hypervisor, vm)
+
+    def unassign(self, vm, hypervisor):
+        """Move the VM back to its current hypervisor in the plan"""
+        self._remove(hypervisor, vm)
+        source = self.get_hypervisor(vm.hypervisor.fqdn)
+        if source is not None:
+            self._add(source, vm)
+
+    def plan(self, vms):
+        """Assign all VMs and return the plan
+
+        The VMs are given as tuples with the offline flag.  The larger VMs
+        are assigned first, because they are harder to place.
+        """
+        migrations = []
+        unplaced = []
+        for vm, offline in largest_first(vms):
+            hypervisor = self.choose(vm)
+            if hypervisor is None:
+                log.warning('Cannot find a hypervisor for {}'.format(vm))
+                unplaced.append(vm.fqdn)
+                continue
+            self.assign(vm, hypervisor)
+            migrations.append({
+                'vm_hostname': vm.fqdn,
+                'hypervisor_hostname': hypervisor.fqdn,
+                'offline': offline,
+            })
+
+        return {'migrations': migrations, 'unplaced': unplaced}
+
+    def _add(self, hypervisor, vm):
+        # XXX: The changes are not meant to be committed to Serveradmin.  We
+        # are bypassing adminapi in here, so they would not be.
+        dict.__setitem__(
+            hypervisor.dataset_obj,
+            'vms',
+            list(hypervisor.dataset_obj['vms']) + [vm.dataset_obj],
+        )
+        self._tallies.add(hypervisor, vm.dataset_obj)
+
+    def _remove(self, hypervisor, vm):
+        vms = list(hypervisor.dataset_obj['vms'])
+        remaining = [
+            v for v in vms if v['hostname'] != vm.dataset_obj['hostname']
+        ]
+        if len(remaining) == len(vms):
+            return
+        dict.__setitem__(hypervisor.dataset_obj, 'vms', remaining)
+        self._tallies.remove(hypervisor, vm.dataset_obj)
+
+
+def largest_first(vms):
+    """Sort the VMs to place the ones harder to place first"""
+    return sorted(vms, key=lambda v: (
+        -v[0].dataset_obj['memory'], -v[0].dataset_obj['disk_size_gib']
+    ))
+
+
+def save_plan(plan, path):
+    with open(path, 'w') as fd:
+        json.dump(plan, fd, indent=4, sort_keys=True)
+
+
+def load_plan(path):
+    """Load a plan and return the migrations by the VM hostnames"""
+    with open(path) as fd:
+        plan = json.load(fd)
+    return {m['vm_hostname']: m for m in plan['migrations']}
@@ -29,8 +29,14 @@ COMMON_FABRIC_SETTINGS = dict(
     timeout=5,
     connection_attempts=1,
     remote_interrupt=True,
+    # Seconds between the keepalive messages to detect lost connections
+    keepalive=10,
 )
 
+# Number of commands to run at the same time on the SSH connection to
+# a host.  OpenSSH allows 10 sessions per connection by default.
+SSH_MAX_CHANNELS = 8
+
 VG_NAME = 'xen-data'
 # Reserved pool space on Hypervisor
 # TODO: this could be a percent value, at least for ZFS.
@@ -47,6 +53,15 @@ HOST_RESERVED_MEMORY = {
 
 VM_OVERHEAD_MEMORY = 50
 
+# Maximum age of the resource usage snapshot of the domains on a hypervisor
+# in seconds
+DOMAIN_STATS_MAX_AGE = 5
+
+# Interval in seconds of the keepalive messages on the libvirt connections,
+# and the number of unanswered ones after which a connection is dead
+LIBVIRT_KEEPALIVE_INTERVAL = 5
+LIBVIRT_KEEPALIVE_COUNT = 6
+
 
 # Default max number of CPUs, unless the hypervisor has fewer cores or num_cpu
 # is larger than this value.
@@ -64,6 +79,84 @@ KVM_HWMODEL_TO_CPUMODEL = {
 }
 
 
+# Tuning profiles of DRBD for the migrations.  The resync starts at
+# the rate in MiB/s, and it is adjusted between the min and max rates
+# by the measured throughput.  Measured max-buffers vs MB/s were 4k-150,
+# 8k-233, 12k-330, 16K-397, 24k-561, 32k-700.  32k seems jumpy and might
+# end up at as low as 250MB/s.
+DRBD_PROFILES = {
+    'slow': {
+        'max_buffers': '12k',
+        'rate': 300,
+        'min_rate': 50,
+        'max_rate': 400,
+    },
+    'default': {
+        'max_buffers': '24k',
+        'rate': 750,
+        'min_rate': 100,
+        'max_rate': 750,
+    },
+    'fast': {
+        'max_buffers': '24k',
+        'rate': 750,
+        'min_rate': 100,
+        'max_rate': 1500,
+    },
+}
+
+# DRBD tuning profiles by the hardware models of the hypervisors.  The slower
+# profile of the source and the destination is used.
+DRBD_HARDWARE_PROFILES = {
+    'Dell_R510': 'slow',
+    'Dell_M610': 'slow',
+    'Dell_M710': 'slow',
+    'Dell_M640': 'fast',
+    'Dell_R640': 'fast',
+}
+
+
+# Seconds between the statistics requested from the DRBD event streams
+DRBD_EVENTS_POLL_INTERVAL = 2
+
+
+# Compression of the disk on the wire for the sparse offline transport.  The
+# blocks of zeros compress to almost nothing, lz4 -1 and lz4 -d can be used
+# instead to save CPU on fast networks.
+MIGRATE_COMPRESSOR = 'zstd -T0 -1'
+MIGRATE_DECOMPRESSOR = 'zstd -d'
+
+# The blocks of zeros of this size are skipped by the sparse offline
+# transport on the target
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+# The parallel offline transport splits the disk into this many ranges,
+# and sends them over separate connections.  The ports above the base are
+# divided into slots of the max streams, and the slot is chosen by the minor
+# number of the target device.
+MIGRATE_PARALLEL_STREAMS = 8
+MIGRATE_PARALLEL_MAX_STREAMS = 32
+MIGRATE_PARALLEL_PORT_BASE = 20000
+
+# The resumable offline transport keeps track of the chunks of this size
+# written to the target on a manifest in the directory
+MIGRATE_CHUNK_SIZE_MIB = 64
+MIGRATE_MANIFEST_PATH = '/var/lib/igvm/manifests'
+
+# Number of chunks hashed one after the other on a channel, the groups are
+# hashed in parallel
+MIGRATE_HASH_GROUP_SIZE = 64
+
+# Size of the LVM snapshot the precopy offline transport copies the disk
+# from while the VM is running, as lvcreate --extents accepts it.  It must
+# be large enough for the writes to the disk until the VM is stopped,
+# because only the chunks changed on it are sent afterwards.
+MIGRATE_SNAPSHOT_SIZE = '20%ORIGIN'
+
+# Seconds between the progress reports of the offline transports
+MIGRATE_PROGRESS_INTERVAL = 10
+
+
 # There are various combinations of source and target HVs which come
 # with their own bugs and must be addressed separately.
 MIGRATE_CONFIG = {
@@ -88,18 +181,69 @@ MIGRATE_CONFIG = {
     # it works fine again.
 }
 
+# Live migrations are watched for converging.  When the remaining memory
+# has not reached a new low for the stall time in seconds, the policies are
+# applied in order until one has an effect: "downtime" raises the maximum
+# downtime up to its limit, "speed" raises the bandwidth limit of the
+# migration up to its limit in MiB/s, "postcopy" switches to post-copy, and
+# "abort" aborts the migration.  The speed policy needs the max speed to be
+# set, it is not enabled by default not to exceed the bandwidth limits
+# given by the users.  Post-copy is not enabled by default either, because
+# the VM is lost, if the network fails after switching to it.
+LIVE_MIGRATION_POLICIES = ['downtime', 'abort']
+LIVE_MIGRATION_STALL_TIME = 60
+LIVE_MIGRATION_MAX_DOWNTIME_MS = 2000
+LIVE_MIGRATION_MAX_SPEED = None
+
+# The statistics of the live migrations are appended to this file as
+# JSON lines for later analysis
+LIVE_MIGRATION_RECORD_PATH = environ.get('IGVM_MIGRATION_RECORDS')
+
 # Arbitrarily chosen MAC address prefix with U/L bit set
 # It will be padded with the last three octets of the internal IP address.
 MAC_ADDRESS_PREFIX = (0xCA, 0xFE, 0x01)
 
 try:
     IGVM_IMAGE_URL = environ['IGVM_IMAGE_URL']
-    IGVM_IMAGE_MD5_URL = IGVM_IMAGE_URL + '.md5'
+    IGVM_IMAGE_SHA256_URL = IGVM_IMAGE_URL + '.sha256'
 except KeyError:
     print('Please set the IGVM_IMAGE_URL environment variable')
     raise
 
-IMAGE_PATH = '/tmp'
+# The images are cached on the hypervisors by their checksums.  The least
+# recently used ones are removed when the cache grows over the size.
+IMAGE_PATH = '/var/cache/igvm/images'
+IMAGE_CACHE_SIZE_GIB = 20
+
+# Formats of the base images by the os attribute of the VMs, the others are
+# tar.gz.  The images need to be available on the image server.
+IMAGE_FORMATS = {}
+
+# Multithreaded decompressors to extract the images with by their formats.
+# Pigz is preferred, but not required, for the existing images.
+IMAGE_DECOMPRESSORS = {
+    'tar.gz': '"$(command -v pigz || echo gzip)"',
+    'tar.zst': '"zstd -T0"',
+}
+
+# Size of the volumes on the hypervisors with the images extracted to clone
+# the VMs from.  Smaller VMs are built by extracting the image.  So are the
+# VMs larger than the given multiple of it, because growing the file system
+# that much would leave it with many small allocation groups.
+GOLDEN_VOLUME_SIZE_GIB = 4
+GOLDEN_VOLUME_MAX_GROWTH = 4
+
+# Disk space in GiB kept on the hypervisors for the golden volumes of that
+# many images and the image cache.  It is reserved in addition to the other
+# reserved disk space.
+GOLDEN_VOLUME_RESERVED_COUNT = 3
+IMAGE_RESERVED_DISK_GIB = (
+    GOLDEN_VOLUME_RESERVED_COUNT * GOLDEN_VOLUME_SIZE_GIB +
+    IMAGE_CACHE_SIZE_GIB
+)
+
+# Number of hypervisors to prefetch the images to at the same time
+IMAGE_PREFETCH_PARALLEL = 10
 
 HYPERVISOR_ATTRIBUTES = [
     'cpu_util_pct',
@@ -162,12 +306,22 @@ VM_ATTRIBUTES = [
     {'hypervisor': HYPERVISOR_ATTRIBUTES},
 ]
 
+# Number of the preferred hypervisors to validate concurrently while
+# looking for the best one
+HYPERVISOR_PROBE_WORKERS = 4
+
+# Interval in seconds to log the progress of an evacuation, if nothing
+# else happens
+EVACUATION_PROGRESS_INTERVAL = 60
+
 # The list is ordered from more important to less important.  The next
 # preference is only going to be checked when the previous ones return all
 # the same values.
 HYPERVISOR_PREFERENCES = [
     # We assume 10 GiB for root partition, 16 for swap, and 6 reserved.
-    InsufficientResource('disk_size_gib', reserved=32),
+    InsufficientResource(
+        'disk_size_gib', reserved=32 + IMAGE_RESERVED_DISK_GIB
+    ),
     InsufficientResource('memory'),
     # Checks the maximum vCPU usage (95 percentile) of the given hypervisor
     # for the given time_range and dismisses it as target when it is over
@@ -0,0 +1,452 @@
+"""igvm - Block Transfers
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from contextlib import contextmanager
+from io import BytesIO
+from logging import getLogger
+from os.path import basename
+from time import sleep
+
+from igvm.exceptions import StorageError
+from igvm.settings import (
+    MIGRATE_CHUNK_SIZE_MIB,
+    MIGRATE_HASH_GROUP_SIZE,
+    MIGRATE_MANIFEST_PATH,
+    MIGRATE_PARALLEL_MAX_STREAMS,
+    MIGRATE_PARALLEL_PORT_BASE,
+    MIGRATE_PARALLEL_STREAMS,
+    MIGRATE_PROGRESS_INTERVAL,
+)
+
+log = getLogger(__name__)
+
+MiB = 1024 ** 2
+
+
+class ParallelTransfer(object):
+    """Copy a device to another hypervisor over parallel connections
+
+    The device is split into byte ranges.  Every range is sent over its own
+    netcat connection, and written at its offset on the target device.
+    The ranges are hashed while they are sent, and read back and hashed
+    on the target afterwards to verify them.
+    """
+    def __init__(self, source_hv, source_device, target_hv, target_device,
+                 size, streams=MIGRATE_PARALLEL_STREAMS, max_bandwidth=None):
+        if not 0 < streams <= MIGRATE_PARALLEL_MAX_STREAMS:
+            raise StorageError(
+                'Number of streams must be between 1 and {}'
+                .format(MIGRATE_PARALLEL_MAX_STREAMS)
+            )
+
+        self.source_hv = source_hv
+        self.source_device = source_device
+        self.target_hv = target_hv
+        self.target_device = target_device
+        self.streams = streams
+        # Bandwidth limit per stream in MiB/s
+        self.max_rate = (
+            max(max_bandwidth // streams, 1) if max_bandwidth else None
+        )
+
+        # List of offset and length tuples in MiB
+        total = -(-size // MiB)
+        length = -(-total // streams)
+        self.ranges = [
+            (offset, min(length, total - offset))
+            for offset in range(0, total, length)
+        ]
+
+        # Cached properties
+        self.ports = None
+
+    def get_ports(self):
+        if self.ports is None:
+            dev_minor = int(self.target_hv.run(
+                'stat -L -c "%T" {}'.format(self.target_device),
+                silent=True,
+            ), 16)
+            slots = (65536 - MIGRATE_PARALLEL_PORT_BASE) // (
+                MIGRATE_PARALLEL_MAX_STREAMS
+            )
+            base = MIGRATE_PARALLEL_PORT_BASE + (
+                dev_minor % slots * MIGRATE_PARALLEL_MAX_STREAMS
+            )
+            ports = [base + i for i in range(len(self.ranges))]
+            if ports[-1] > 65535:
+                raise StorageError('Port {} is out of range'.format(ports[-1]))
+            self.ports = ports
+        return self.ports
+
+    def run(self):
+        with self.temp_dir(self.source_hv) as source_dir, \
+                self.temp_dir(self.target_hv) as target_dir:
+            with self.listen(target_dir):
+                self.send(source_dir)
+                self.wait(source_dir, target_dir)
+            self.verify(source_dir)
+
+    @contextmanager
+    def temp_dir(self, hv):
+        path = hv.run('mktemp -d --suffix -igvm-transfer', silent=True)
+        try:
+            yield path
+        finally:
+            hv.run('rm -rf {}'.format(path), silent=True)
+
+    @contextmanager
+    def listen(self, target_dir):
+        """Start the listeners of the ranges on the target"""
+        for port in self.get_ports():
+            self.target_hv.check_netcat(port)
+
+        self.target_hv.run(' '.join(
+            'nohup sh -c \''
+            '/bin/nc.traditional -l -p {port} | '
+            'dd of={device} bs=1M seek={offset} iflag=fullblock '
+            'conv=notrunc,fsync status=none ; '
+            'echo $? > {dir}/{index}.status'
+            '\' > /dev/null 2>&1 &'
+            .format(
+                port=port,
+                device=self.target_device,
+                offset=offset,
+                dir=target_dir,
+                index=index,
+            )
+            for index, ((offset, length), port) in enumerate(
+                zip(self.ranges, self.get_ports())
+            )
+        ))
+        try:
+            yield
+        except BaseException:
+            # Some of the listeners may have already finished.
+            for port in self.get_ports():
+                self.target_hv.run(
+                    'pkill -f "^/bin/nc.traditional -l -p {}"'.format(port),
+                    warn_only=True,
+                )
+            raise
+
+    def send(self, source_dir):
+        """Start sending the ranges from the source"""
+        self.source_hv.run(' '.join(
+            'nohup sh -c \''
+            'mkfifo {dir}/{index}.fifo ; '
+            'md5sum < {dir}/{index}.fifo | '
+            'cut -d" " -f1 > {dir}/{index}.md5 & '
+            'dd if={device} bs=1M skip={offset} count={length} status=none | '
+            'pv -n -b -f{limit} 2> {dir}/{index}.progress | '
+            'tee {dir}/{index}.fifo | '
+            '/bin/nc.traditional -q 1 {host} {port} ; '
+            's=$? ; wait ; echo $s > {dir}/{index}.status'
+            '\' > /dev/null 2>&1 &'
+            .format(
+                dir=source_dir,
+                index=index,
+                device=self.source_device,
+                offset=offset,
+                length=length,
+                limit=' -L {}m'.format(self.max_rate) if self.max_rate else '',
+                host=self.target_hv.fqdn,
+                port=port,
+            )
+            for index, ((offset, length), port) in enumerate(
+                zip(self.ranges, self.get_ports())
+            )
+        ))
+
+    def wait(self, source_dir, target_dir):
+        """Wait for the ranges to be sent and written, and log progress"""
+        total = sum(length for offset, length in self.ranges) * MiB
+        while True:
+            sleep(MIGRATE_PROGRESS_INTERVAL)
+            progress = self._read_states(self.source_hv, source_dir, True)
+            sent = sum(b for b, s in progress)
+            log.info('Transferred {:.0f}% ({})'.format(
+                100.0 * sent / total,
+                ', '.join(
+                    '{:.0f}%'.format(100.0 * b / (length * MiB))
+                    for (b, s), (offset, length) in zip(progress, self.ranges)
+                ),
+            ))
+
+            failed = [i for i, (b, s) in enumerate(progress) if s]
+            if failed:
+                raise StorageError(
+                    'Sending ranges {} to {} failed'.format(
+                        ', '.join(str(i) for i in failed), self.target_hv
+                    )
+                )
+            if all(s is not None for b, s in progress):
+                break
+
+        # The source is done, once the target has received everything.
+        while True:
+            states = self._read_states(self.target_hv, target_dir)
+            failed = [i for i, (b, s) in enumerate(states) if s]
+            if failed:
+                raise StorageError('Writing ranges {} on {} failed'.format(
+                    ', '.join(str(i) for i in failed), self.target_hv
+                ))
+            if all(s is not None for b, s in states):
+                break
+            sleep(1)
+
+    def verify(self, source_dir):
+        """Compare the checksums of the ranges on both sides"""
+        source_sums = self.source_hv.run(
+            'cat ' + ' '.join(
+                '{}/{}.md5'.format(source_dir, i)
+                for i in range(len(self.ranges))
+            ),
+            silent=True,
+        ).split()
+        target_sums = self.target_hv.run_parallel(
+            [
+                'dd if={} bs=1M skip={} count={} status=none | '
+                'md5sum | cut -d" " -f1'
+                .format(self.target_device, offset, length)
+                for offset, length in self.ranges
+            ],
+            silent=True,
+        )
+
+        mismatches = [
+            i for i, (s, t) in enumerate(zip(source_sums, target_sums))
+            if s != t
+        ]
+        if len(source_sums) != len(self.ranges) or mismatches:
+            raise StorageError(
+                'Checksums of ranges {} do not match on {}'.format(
+                    ', '.join(str(i) for i in mismatches) or 'all',
+                    self.target_hv,
+                )
+            )
+        log.info('Verified {} ranges on {}'.format(
+            len(self.ranges), self.target_hv
+        ))
+
+    def _read_states(self, hv, path, with_progress=False):
+        """Return the bytes sent and the exit codes of the ranges
+
+        The exit codes are None for the ranges still running.
+        """
+        lines = hv.run(
+            'for i in $(seq 0 {}) ; do '
+            'p=$({}) ; s=$(cat {}/$i.status 2> /dev/null) ; '
+            'echo ${{p:-0}} ${{s:--}} ; '
+            'done'
+            .format(
+                len(self.ranges) - 1,
+                'tail -n 1 {}/$i.progress 2> /dev/null'.format(path)
+                if with_progress else '',
+                path,
+            ),
+            silent=True,
+        ).splitlines()
+
+        states = []
+        for line in lines:
+            sent, status = line.split()
+            states.append((
+                int(sent) if sent.isdigit() else 0,
+                None if status == '-' else int(status),
+            ))
+        return states
+
+
+class ResumableTransfer(object):
+    """Copy a device to another hypervisor in chunks that are kept track of
+
+    A manifest of the chunks written and verified on the target device
+    is kept next to it.  When the transfer is started again after
+    a failure, only the chunks that are missing on the manifest or differ
+    from the source are sent.  The target device must be kept between
+    the attempts for this.
+    """
+    def __init__(self, source_hv, source_device, target_hv, target_device,
+                 size, max_bandwidth=None, resume=True):
+        self.source_hv = source_hv
+        self.source_device = source_device
+        self.target_hv = target_hv
+        self.target_device = target_device
+        self.size = -(-size // MiB)
+        self.max_bandwidth = max_bandwidth
+        self.resume = resume
+        self.manifest = '{}/{}.manifest'.format(
+            MIGRATE_MANIFEST_PATH, basename(target_device)
+        )
+
+    def run(self, cleanup=True, changes=None):
+        """Send the chunks, remove the manifest afterwards with cleanup
+
+        When the changes of the source since the manifest was complete are
+        known, they can be passed as byte ranges to hash and compare only
+        the chunks they touch.
+        """
+        target_chunks = self.get_target_chunks()
+        places = None
+        if changes is not None:
+            places = self.get_changed_places(changes)
+        chunks = [
+            c for c in self.get_source_chunks(places)
+            if target_chunks.get(c[:2]) != c[2]
+        ]
+        log.info('Sending {} of {} chunks to {}'.format(
+            len(chunks), -(-self.size // MIGRATE_CHUNK_SIZE_MIB),
+            self.target_hv,
+        ))
+
+        if chunks:
+            self.send(chunks)
+        if cleanup:
+            self.target_hv.run('rm -f {0} {0}.status'.format(self.manifest))
+
+    def get_target_chunks(self):
+        """Return the hashes of the chunks on the manifest by their places
+
+        The chunks being written are marked with "-" on the manifest.
+        The last line of a chunk wins.
+        """
+        self.target_hv.run('mkdir -p {}'.format(MIGRATE_MANIFEST_PATH))
+        if not self.resume:
+            self.target_hv.run('rm -f {0} {0}.status'.format(self.manifest))
+            return {}
+
+        chunks = {}
+        output = self.target_hv.run(
+            'cat {} 2> /dev/null || true'.format(self.manifest), silent=True
+        )
+        for line in output.splitlines():
+            offset, length, digest = line.split()
+            chunks[(int(offset), int(length))] = digest
+        return chunks
+
+    def get_places(self):
+        """Return the offsets and the lengths of all chunks in MiB"""
+        return [
+            (o, min(MIGRATE_CHUNK_SIZE_MIB, self.size - o))
+            for o in range(0, self.size, MIGRATE_CHUNK_SIZE_MIB)
+        ]
+
+    def get_changed_places(self, changes):
+        """Return the places of the chunks touched by the byte ranges"""
+        chunk_size = MIGRATE_CHUNK_SIZE_MIB * MiB
+        touched = set()
+        for offset, length in changes:
+            touched.update(range(
+                offset // chunk_size, (offset + length - 1) // chunk_size + 1
+            ))
+        return [
+            p for p in self.get_places()
+            if p[0] // MIGRATE_CHUNK_SIZE_MIB in touched
+        ]
+
+    def get_source_chunks(self, places=None):
+        """Return the places and the hashes of the chunks of the source
+
+        All chunks are hashed without the places.  The chunks are split
+        into groups that are hashed at the same time on their own
+        channels.
+        """
+        if places is None:
+            places = self.get_places()
+        commands = []
+        for i in range(0, len(places), MIGRATE_HASH_GROUP_SIZE):
+            commands.append(
+                'for c in {places} ; do o=${{c%:*}} ; l=${{c#*:}} ; '
+                'echo $o $l $('
+                'dd if={device} bs=1M skip=$o count=$l status=none | '
+                'md5sum | cut -d" " -f1'
+                ') ; done'
+                .format(
+                    places=' '.join(
+                        '{}:{}'.format(*p)
+                        for p in places[i:i + MIGRATE_HASH_GROUP_SIZE]
+                    ),
+                    device=self.source_device,
+                )
+            )
+
+        chunks = []
+        for output in self.source_hv.run_parallel(commands, silent=True):
+            for line in output.splitlines():
+                offset, length, digest = line.split()
+                chunks.append((int(offset), int(length), digest))
+        return chunks
+
+    def send(self, chunks):
+        """Send the chunks with their places and hashes prepended
+
+        Every chunk is marked as being written on the manifest first, and
+        added to it after it is written and read back with the same hash.
+        """
+        dev_minor = int(self.target_hv.run(
+            'stat -L -c "%T" {}'.format(self.target_device), silent=True,
+        ), 16)
+        port = 7000 + dev_minor
+        self.target_hv.check_netcat(port)
+
+        self.target_hv.run(
+            'rm -f {manifest}.status ; nohup sh -c \''
+            '/bin/nc.traditional -l -p {port} | '
+            'while read o l h ; do '
+            'echo $o $l - >> {manifest} ; '
+            'dd of={device} bs=1M seek=$o count=$l iflag=fullblock '
+            'conv=notrunc,fsync status=none || exit 1 ; '
+            '[ "$(dd if={device} bs=1M skip=$o count=$l status=none | '
+            'md5sum | cut -d" " -f1)" = $h ] || exit 1 ; '
+            'echo $o $l $h >> {manifest} ; '
+            'done ; echo $? > {manifest}.status'
+            '\' > /dev/null 2>&1 &'
+            .format(
+                port=port, device=self.target_device, manifest=self.manifest
+            )
+        )
+        try:
+            list_path = self.source_hv.run('mktemp', silent=True)
+            try:
+                self.source_hv.put(list_path, BytesIO(''.join(
+                    '{} {} {}\n'.format(*c) for c in chunks
+                ).encode()))
+                self.source_hv.run(
+                    'while read o l h ; do echo $o $l $h ; '
+                    'dd if={} bs=1M skip=$o count=$l status=none ; '
+                    'done < {} | pv -f -s {}{} | '
+                    '/bin/nc.traditional -q 1 {} {}'
+                    .format(
+                        self.source_device,
+                        list_path,
+                        sum(c[1] for c in chunks) * MiB,
+                        ' -L {}m'.format(self.max_bandwidth)
+                        if self.max_bandwidth else '',
+                        self.target_hv.fqdn,
+                        port,
+                    )
+                )
+            finally:
+                self.source_hv.run('rm -f {}'.format(list_path), silent=True)
+        except BaseException:
+            self.target_hv.run(
+                'pkill -f "^/bin/nc.traditional -l -p {}"'.format(port),
+                warn_only=True,
+            )
+            raise
+
+        # The target may still be writing the last chunk.
+        while True:
+            status = self.target_hv.run(
+                'cat {}.status 2> /dev/null || true'.format(self.manifest),
+                silent=True,
+            )
+            if status:
+                break
+            sleep(1)
+        if status != '0':
+            raise StorageError('Writing chunks on {} failed'.format(
+                self.target_hv
+            ))
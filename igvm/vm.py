@@ -8,15 +8,20 @@ import os
 import time
 
 from base64 import b64decode
-from fabric.api import cd, get, put, run, settings
+from fabric.api import cd, get, run, settings
 from fabric.contrib.files import upload_template
 from hashlib import sha1, sha256
 from io import BytesIO
 from re import compile as re_compile
-from uuid import uuid4
+from shlex import quote
 
 from igvm.exceptions import ConfigError, RemoteCommandError, VMError
 from igvm.host import Host
+from igvm.settings import (
+    GOLDEN_VOLUME_MAX_GROWTH,
+    GOLDEN_VOLUME_SIZE_GIB,
+    IMAGE_FORMATS,
+)
 from igvm.transaction import Transaction
 from igvm.utils import parse_size, wait_until
 
@@ -56,12 +61,13 @@ class VM(Host):
         else:
             return '/{}'.format(path)
 
-    def run(self, command, silent=False, with_sudo=True):
+    def run(self, command, silent=False, with_sudo=True, **kwargs):
         """ Same as Fabric's run() but works on mounted or running vm
 
             When running in a mounted VM image, run everything in chroot
             and in separate shell inside chroot. Normally Fabric runs shell
-            around commands.
+            around commands.  The other keyword arguments are passed
+            to Host.run().
         """
         with self.vm_host():
             if self.mounted:
@@ -72,9 +78,40 @@ class VM(Host):
                     shell=False, shell_escape=True,
                     silent=silent,
                     with_sudo=with_sudo,
+                    **kwargs
                 )
             else:
-                return super(VM, self).run(command, silent=silent)
+                return super(VM, self).run(command, silent=silent, **kwargs)
+
+    def _run_script(self, script, silent=False):
+        if self.mounted:
+            return self.hypervisor.run(
+                'chroot {} /bin/sh -c {}'.format(
+                    self.vm_path(''), quote(script)
+                ),
+                shell=False,
+                silent=silent,
+                warn_only=True,
+                pty=False,
+            )
+        return super(VM, self)._run_script(script, silent=silent)
+
+    def run_parallel(self, commands, silent=False, with_sudo=True):
+        """Same as Host.run_parallel() but works on mounted or running vm"""
+        if self.mounted:
+            return self.hypervisor.run_parallel(
+                [
+                    'chroot {} /bin/sh -c {}'.format(
+                        self.vm_path(''), quote(c)
+                    )
+                    for c in commands
+                ],
+                silent=silent,
+                with_sudo=with_sudo,
+            )
+        return super(VM, self).run_parallel(
+            commands, silent=silent, with_sudo=with_sudo
+        )
 
     def read_file(self, path):
         """Read a file from a running VM or a mounted image on HV."""
@@ -100,19 +137,17 @@ class VM(Host):
         with self.vm_host():
             return get(self.vm_path(remote_path), local_path, temp_dir='/tmp')
 
-    def put(self, remote_path, local_path, mode='0644'):
-        """ Same as Fabric's put() but works on mounted or running vm
+    def put(self, remote_path, local_path, mode='0644', owner=None):
+        """ Same as Host.put() but works on mounted or running vm
 
-            Setting permissions on files and using sudo via Fabric's put()
-            seems broken, at least for mounted VM. This is why we run
-            extra commands here.
+            The owner of the files on a mounted VM is resolved on the
+            hypervisor, so better be given numerically.
         """
-        with self.vm_host():
-            tempfile = '/tmp/' + str(uuid4())
-            put(local_path, self.vm_path(tempfile))
-            self.run('mv {0} {1} ; chmod {2} {1}'.format(
-                tempfile, remote_path, mode
-            ))
+        if self.mounted:
+            return self.hypervisor.put(
+                self.vm_path(remote_path), local_path, mode, owner
+            )
+        return super(VM, self).put(remote_path, local_path, mode, owner)
 
     def set_state(self, new_state, transaction=None):
         """Changes state of VM for LB and Nagios downtimes"""
@@ -287,12 +322,20 @@ class VM(Host):
             result['status'] = 'new'
         return result
 
-    def build(self, run_puppet=True, debug_puppet=False, postboot=None):
-        """Builds a VM."""
+    def build(self, run_puppet=True, debug_puppet=False, postboot=None,
+              golden=False):
+        """Builds a VM.
+
+        With golden, the storage is cloned from the golden volume of
+        the image on the hypervisor instead of extracting the image.
+        """
         hypervisor = self.hypervisor
         self.check_serveradmin_config()
 
-        image = self.dataset_obj['os'] + '-base.tar.gz'
+        image = '{}-base.{}'.format(
+            self.dataset_obj['os'],
+            IMAGE_FORMATS.get(self.dataset_obj['os'], 'tar.gz'),
+        )
 
         # Can VM run on given hypervisor?
         self.hypervisor.check_vm(self, offline=True)
@@ -303,12 +346,31 @@ class VM(Host):
                 'configuration.  Expect things to go south.'
             )
 
+        if golden and not (
+            GOLDEN_VOLUME_SIZE_GIB <=
+            self.dataset_obj['disk_size_gib'] <=
+            GOLDEN_VOLUME_SIZE_GIB * GOLDEN_VOLUME_MAX_GROWTH
+        ):
+            log.warning(
+                'The disk of the VM is too small or too large for the golden '
+                'volume.  Extracting the image instead.'
+            )
+            golden = False
+
         with Transaction() as transaction:
             # Perform operations on the hypervisor
-            self.hypervisor.create_vm_storage(self, transaction)
-            mount_path = self.hypervisor.format_vm_storage(self, transaction)
-
-            self.hypervisor.download_and_extract_image(image, mount_path)
+            if golden:
+                self.hypervisor.clone_vm_storage(self, image, transaction)
+                mount_path = self.hypervisor.mount_vm_storage(
+                    self, transaction
+                )
+                self.hypervisor.run('xfs_growfs {}'.format(mount_path))
+            else:
+                self.hypervisor.create_vm_storage(self, transaction)
+                mount_path = self.hypervisor.format_vm_storage(
+                    self, transaction
+                )
+                self.hypervisor.download_and_extract_image(image, mount_path)
 
             self.prepare_vm()
 
@@ -368,11 +430,6 @@ class VM(Host):
 
         VM storage must be mounted on the hypervisor.
         """
-        fd = BytesIO()
-        fd.write(self.fqdn.encode())
-        self.put('/etc/hostname', fd)
-        self.put('/etc/mailname', fd)
-
         self.upload_template('etc/fstab', 'etc/fstab', {
             'blk_dev': self.hypervisor.vm_block_device_name(),
             'type': 'xfs',
@@ -382,12 +439,17 @@ class VM(Host):
         self.upload_template('etc/inittab', '/etc/inittab')
 
         # Copy resolv.conf from Hypervisor
-        fd = BytesIO()
+        resolv_conf = BytesIO()
         with self.hypervisor.fabric_settings(
             cd(self.hypervisor.vm_mount_path(self))
         ):
-            get('/etc/resolv.conf', fd)
-        self.put('/etc/resolv.conf', fd)
+            get('/etc/resolv.conf', resolv_conf)
+
+        hostname = BytesIO(self.fqdn.encode())
+        with self.batch() as batch:
+            batch.put('/etc/hostname', hostname)
+            batch.put('/etc/mailname', hostname)
+            batch.put('/etc/resolv.conf', resolv_conf)
 
         self.create_ssh_keys()
 
@@ -403,16 +465,18 @@ class VM(Host):
         fp_types = [(1, sha1), (2, sha256)]
 
         # This will also create the public key files.
-        for key_id, key_type in key_types:
-            self.run(
-                'ssh-keygen -q -t {0} -N "" '
-                '-f /etc/ssh/ssh_host_{0}_key'
-                .format(key_type)
-            )
-
-            fd = BytesIO()
-            self.get('/etc/ssh/ssh_host_{0}_key.pub'.format(key_type), fd)
-            pub_key = b64decode(fd.getvalue().split(None, 2)[1])
+        self.run_parallel([
+            'ssh-keygen -q -t {0} -N "" -f /etc/ssh/ssh_host_{0}_key'
+            .format(key_type)
+            for key_id, key_type in key_types
+        ])
+        with self.batch(silent=True) as batch:
+            for key_id, key_type in key_types:
+                batch.run('cat /etc/ssh/ssh_host_{0}_key.pub'.format(key_type))
+        for (key_id, key_type), (return_code, output) in zip(
+            key_types, batch.results
+        ):
+            pub_key = b64decode(output.split(None, 2)[1])
             for fp_id, fp_type in fp_types:
                 self.dataset_obj['sshfp'].add('{} {} {}'.format(
                     key_id, fp_id, fp_type(pub_key).hexdigest()
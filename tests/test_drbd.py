@@ -0,0 +1,106 @@
+"""igvm - DRBD Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from unittest import TestCase
+
+from igvm.drbd import DRBDEvents, _metadata_size
+
+# Records of "drbdsetup events2 --statistics" with the expected states of
+# the resource after them
+EVENTS = [
+    (
+        'exists resource name:vm1 role:Secondary suspended:no',
+        {'disk': None, 'peer_disk': None, 'replication': None},
+    ),
+    (
+        'exists device name:vm1 volume:0 minor:10 disk:Inconsistent '
+        'client:no size:1048576 read:0 written:0',
+        {'disk': 'Inconsistent', 'size': 1048576},
+    ),
+    (
+        'exists peer-device name:vm1 peer-node-id:1 conn-name:hv2 '
+        'volume:0 replication:SyncTarget peer-disk:UpToDate '
+        'resync-suspended:no received:0 sent:0 out-of-sync:1048576',
+        {
+            'replication': 'SyncTarget',
+            'peer_disk': 'UpToDate',
+            'out_of_sync': 1048576,
+        },
+    ),
+    (
+        'change peer-device name:vm1 peer-node-id:1 conn-name:hv2 '
+        'volume:0 received:524288 out-of-sync:524288 done:50.00',
+        {'out_of_sync': 524288, 'done': 50.0, 'disk': 'Inconsistent'},
+    ),
+    (
+        'change device name:vm1 volume:0 disk:UpToDate',
+        {'disk': 'UpToDate', 'peer_disk': 'UpToDate'},
+    ),
+]
+
+
+class DRBDEventsTest(TestCase):
+    def setUp(self):
+        self.events = DRBDEvents('hv1.example.com')
+
+    def test_records(self):
+        for line, expected in EVENTS:
+            self.events.handle(line.split())
+            resource = self.events.resources['vm1']
+            for attribute, value in expected.items():
+                self.assertEqual(
+                    getattr(resource, attribute), value, msg=line
+                )
+        self.assertTrue(self.events.resources['vm1'].synced())
+        self.assertIn('50.0% done', resource.progress())
+
+    def test_initialized(self):
+        self.assertFalse(self.events.initialized)
+        self.events.handle(['exists', '-'])
+        self.assertTrue(self.events.initialized)
+        self.assertEqual(self.events.resources, {})
+
+    def test_destroy(self):
+        self.events.handle(EVENTS[1][0].split())
+        self.events.handle('destroy resource name:vm1'.split())
+        self.assertNotIn('vm1', self.events.resources)
+
+    def test_ignored(self):
+        for line in ['', 'change', 'call helper volume:0 helper:foo']:
+            self.events.handle(line.split())
+        self.assertEqual(self.events.resources, {})
+
+    def test_resources(self):
+        self.events.handle(
+            'change device name:vm1 volume:0 disk:UpToDate'.split()
+        )
+        self.events.handle(
+            'change device name:vm2 volume:0 disk:Outdated'.split()
+        )
+        self.assertEqual(self.events.resources['vm1'].disk, 'UpToDate')
+        self.assertEqual(self.events.resources['vm2'].disk, 'Outdated')
+
+
+# Sizes of the devices in bytes with the sizes of their metadata in KiB.
+# A bitmap sector covers 128 MiB of the device.
+METADATA_SIZES = [
+    (0, 36),
+    (1, 40),
+    (512, 40),
+    (128 * 1024 ** 2 - 1, 40),
+    (128 * 1024 ** 2, 40),
+    (128 * 1024 ** 2 + 1, 44),
+    (128 * 1024 ** 2 + 512, 44),
+    (256 * 1024 ** 2, 44),
+    (1024 ** 4, 32804),
+]
+
+
+class MetadataSizeTest(TestCase):
+    def test_metadata_size(self):
+        for device_size, expected in METADATA_SIZES:
+            self.assertEqual(
+                _metadata_size(device_size), expected, msg=device_size
+            )
@@ -0,0 +1,102 @@
+"""igvm - Evacuation Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from unittest import TestCase
+
+from igvm.evacuation import EvacuationScheduler
+from igvm.exceptions import IGVMError, UnsuitableHypervisorError
+
+
+class _Hypervisor(object):
+    def __init__(self, fqdn):
+        self.fqdn = fqdn
+        self.locked = False
+
+    def __str__(self):
+        return self.fqdn
+
+    def acquire_lock(self):
+        self.locked = True
+
+    def release_lock(self):
+        self.locked = False
+
+
+class _VM(object):
+    def __init__(self, fqdn):
+        self.fqdn = fqdn
+        self.dataset_obj = {'memory': 1024, 'disk_size_gib': 10}
+
+    def __str__(self):
+        return self.fqdn
+
+
+class _Planner(object):
+    def __init__(self, *hypervisors):
+        self.hypervisors = hypervisors
+        self.assigned = {}
+
+    def get_hypervisor(self, hostname):
+        return None
+
+    def choose(self, vm, exclude=()):
+        for hypervisor in self.hypervisors:
+            if hypervisor not in exclude:
+                return hypervisor
+        return None
+
+    def assign(self, vm, hypervisor):
+        self.assigned[vm] = hypervisor
+
+    def unassign(self, vm, hypervisor):
+        del self.assigned[vm]
+
+
+def _interrupt(vm_hostname, hypervisor_hostname, offline, max_bandwidth):
+    raise KeyboardInterrupt()
+
+
+def _reject_first(vm_hostname, hypervisor_hostname, offline, max_bandwidth):
+    if hypervisor_hostname == 'hv1.example.com':
+        raise UnsuitableHypervisorError('Not enough memory.')
+
+
+class EvacuationSchedulerTest(TestCase):
+    def test_interrupted_worker(self):
+        hypervisor = _Hypervisor('hv.example.com')
+        planner = _Planner(hypervisor)
+        scheduler = EvacuationScheduler(_interrupt, planner)
+
+        with self.assertRaises(IGVMError) as context:
+            scheduler.run([(_VM('vm.example.com'), False)])
+
+        self.assertIn('vm.example.com', str(context.exception))
+        self.assertIn('KeyboardInterrupt', str(context.exception))
+        self.assertFalse(hypervisor.locked)
+        self.assertEqual(planner.assigned, {})
+
+    def test_rejected_hypervisor(self):
+        hypervisors = [
+            _Hypervisor('hv1.example.com'), _Hypervisor('hv2.example.com')
+        ]
+        planner = _Planner(*hypervisors)
+        scheduler = EvacuationScheduler(_reject_first, planner)
+        vm = _VM('vm.example.com')
+
+        scheduler.run([(vm, False)])
+
+        self.assertEqual(planner.assigned, {vm: hypervisors[1]})
+        self.assertFalse(any(h.locked for h in hypervisors))
+
+    def test_rejected_by_all_hypervisors(self):
+        hypervisor = _Hypervisor('hv1.example.com')
+        planner = _Planner(hypervisor)
+        scheduler = EvacuationScheduler(_reject_first, planner)
+
+        with self.assertRaises(IGVMError) as context:
+            scheduler.run([(_VM('vm.example.com'), False)])
+
+        self.assertIn('Cannot find a hypervisor', str(context.exception))
+        self.assertEqual(planner.assigned, {})
@@ -0,0 +1,120 @@
+"""igvm - Hypervisor Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from os import close, remove
+from struct import pack
+from subprocess import PIPE, run
+from tempfile import mkstemp
+from unittest import TestCase
+from unittest.mock import patch
+
+from igvm.hypervisor import Hypervisor
+
+SNAPSHOT = '/dev/xen-data/igvm_snapshot_1'
+STORE = '253:5'
+# Chunk size of the snapshot in sectors
+CHUNK_SECTORS = 8
+CHUNK = CHUNK_SECTORS * 512
+EXCEPTIONS_PER_AREA = CHUNK // 16
+MiB = 1024 ** 2
+
+# Origin chunk numbers of the exceptions, the granularity, and the changed
+# byte ranges expected
+SNAPSHOT_CHANGES = [
+    ([], MiB, []),
+    ([0], CHUNK, [(0, CHUNK)]),
+    ([0, 1, 255], MiB, [(0, MiB)]),
+    ([256, 0, 1000], MiB, [(0, MiB), (MiB, MiB), (3 * MiB, MiB)]),
+    # Smaller granularity than the chunk size is rounded up.
+    ([3], 512, [(3 * CHUNK, CHUNK)]),
+    # The first metadata area is full, the second one is used.
+    (
+        list(range(EXCEPTIONS_PER_AREA + 2)),
+        CHUNK,
+        [(i * CHUNK, CHUNK) for i in range(EXCEPTIONS_PER_AREA + 2)],
+    ),
+]
+
+
+def _write_store(path, old_chunks):
+    """Write a persistent exception store with the exceptions
+
+    Every metadata area is followed by the data chunks it lists.
+    The data is not needed, so the new chunk numbers are made up.
+    """
+    areas = max(-(-len(old_chunks) // EXCEPTIONS_PER_AREA), 1)
+    if len(old_chunks) % EXCEPTIONS_PER_AREA == 0 and old_chunks:
+        # The next area is started, when the last one is full.
+        areas += 1
+    with open(path, 'wb') as fd:
+        fd.write(b'SnAp'.ljust(CHUNK, b'\0'))
+        for area in range(areas):
+            exceptions = old_chunks[
+                area * EXCEPTIONS_PER_AREA:(area + 1) * EXCEPTIONS_PER_AREA
+            ]
+            fd.write(b''.join(
+                pack('<QQ', old_chunk, 2 + area + i)
+                for i, old_chunk in enumerate(exceptions)
+            ).ljust(CHUNK, b'\0'))
+            fd.write(b'\0' * CHUNK * EXCEPTIONS_PER_AREA)
+    return areas
+
+
+class SnapshotChangesTest(TestCase):
+    def setUp(self):
+        self.hypervisor = Hypervisor({
+            'hostname': 'hv.example.com',
+            'intern_ip': '192.0.2.1',
+            'state': 'online',
+        })
+        fd, self.store_path = mkstemp()
+        close(fd)
+
+    def tearDown(self):
+        remove(self.store_path)
+
+    def _run(self, status):
+        def run_command(command, silent=False):
+            if command.startswith('dmsetup status'):
+                return status
+            if command.startswith('dmsetup table'):
+                return '0 2097152 snapshot 253:4 {} P {}'.format(
+                    STORE, CHUNK_SECTORS
+                )
+            # Read the store from the file instead of the device
+            return run(
+                [
+                    '/bin/sh', '-c', command.replace(
+                        '/dev/block/' + STORE, self.store_path
+                    ),
+                ],
+                stdout=PIPE,
+                check=True,
+            ).stdout.decode().strip()
+        return run_command
+
+    def test_changes(self):
+        for old_chunks, granularity, expected in SNAPSHOT_CHANGES:
+            areas = _write_store(self.store_path, old_chunks)
+            # The header chunk is counted with the metadata areas.
+            status = '0 2097152 snapshot {}/409600 {}'.format(
+                len(old_chunks) * CHUNK_SECTORS,
+                (areas + 1) * CHUNK_SECTORS,
+            )
+            with patch.object(self.hypervisor, 'run', self._run(status)):
+                self.assertEqual(
+                    self.hypervisor.get_snapshot_changes(
+                        SNAPSHOT, granularity
+                    ),
+                    expected,
+                    msg=old_chunks,
+                )
+
+    def test_invalid(self):
+        for status in ['0 2097152 snapshot Invalid', '0 2097152 snapshot']:
+            with patch.object(self.hypervisor, 'run', self._run(status)):
+                self.assertIsNone(
+                    self.hypervisor.get_snapshot_changes(SNAPSHOT, MiB)
+                )
@@ -0,0 +1,101 @@
+"""igvm - Hypervisor Preferences Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from unittest import TestCase
+
+from igvm.hypervisor_preferences import (
+    HypervisorTallies,
+    InsufficientResource,
+    OtherVMs,
+)
+
+
+class _Host(object):
+    def __init__(self, fqdn, dataset_obj):
+        self.fqdn = fqdn
+        self.dataset_obj = dataset_obj
+
+
+def _vm_obj(hostname, memory=1024, function='web'):
+    return {'hostname': hostname, 'memory': memory, 'function': function}
+
+
+class HypervisorTalliesTest(TestCase):
+    def setUp(self):
+        self.hv = _Host('hv.example.com', {
+            'memory': 4096,
+            'vms': [_vm_obj('web1'), _vm_obj('db1', 2048, 'db')],
+        })
+        self.tallies = HypervisorTallies()
+
+    def test_total(self):
+        self.assertEqual(self.tallies.total(self.hv, 'memory'), 3072)
+
+    def test_count(self):
+        # The VM itself is not counted.
+        self.assertEqual(
+            self.tallies.count(self.hv, ['function'], _vm_obj('web1')), 0
+        )
+        self.assertEqual(
+            self.tallies.count(self.hv, ['function'], _vm_obj('web2')), 1
+        )
+        self.assertEqual(self.tallies.count(self.hv, [], _vm_obj('web2')), 2)
+
+    def test_add_remove(self):
+        web2 = _vm_obj('web2')
+        self.tallies.total(self.hv, 'memory')
+        self.tallies.count(self.hv, ['function'], web2)
+
+        self.tallies.add(self.hv, web2)
+        self.assertEqual(self.tallies.total(self.hv, 'memory'), 4096)
+        self.assertEqual(
+            self.tallies.count(self.hv, ['function'], web2), 1
+        )
+        self.assertEqual(
+            self.tallies.count(self.hv, ['function'], _vm_obj('web3')), 2
+        )
+
+        self.tallies.remove(self.hv, web2)
+        self.assertEqual(self.tallies.total(self.hv, 'memory'), 3072)
+        self.assertEqual(
+            self.tallies.count(self.hv, ['function'], _vm_obj('web3')), 1
+        )
+
+    def test_add_before_first_use(self):
+        # The tallies are computed from the VMs on first use, so the VMs
+        # added before are counted from there.
+        web2 = _vm_obj('web2')
+        self.hv.dataset_obj['vms'].append(web2)
+        self.tallies.add(self.hv, web2)
+
+        self.assertEqual(self.tallies.total(self.hv, 'memory'), 4096)
+
+
+class PreferencesTest(TestCase):
+    def setUp(self):
+        self.hv = _Host('hv.example.com', {
+            'memory': 4096,
+            'vms': [_vm_obj('web1', 3072)],
+        })
+        self.tallies = HypervisorTallies()
+
+    def test_insufficient_resource(self):
+        check = InsufficientResource('memory')
+        small = _Host('small', _vm_obj('small', 1024))
+        large = _Host('large', _vm_obj('large', 2048))
+
+        self.assertFalse(check(small, self.hv, self.tallies))
+        self.assertTrue(check(large, self.hv, self.tallies))
+
+        self.tallies.add(self.hv, small.dataset_obj)
+        self.assertTrue(check(small, self.hv, self.tallies))
+
+    def test_other_vms(self):
+        preference = OtherVMs(['function'], ['web'])
+        web = _Host('web2', _vm_obj('web2'))
+        db = _Host('db2', _vm_obj('db2', function='db'))
+
+        self.assertEqual(preference(web, self.hv, self.tallies), 1)
+        self.assertEqual(preference(db, self.hv, self.tallies), 0)
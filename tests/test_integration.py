@@ -11,6 +11,7 @@ from pipes import quote
 from re import match
 from tempfile import NamedTemporaryFile
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import uuid4
 
 from adminapi.dataset import Query
@@ -42,9 +43,11 @@ from igvm.exceptions import (
 from igvm.hypervisor import Hypervisor
 from igvm.settings import (
     COMMON_FABRIC_SETTINGS,
+    GOLDEN_VOLUME_SIZE_GIB,
     HYPERVISOR_ATTRIBUTES,
     VG_NAME,
 )
+from igvm.transfer import ResumableTransfer
 from igvm.utils import parse_size
 
 basicConfig(level=INFO)
@@ -328,6 +331,31 @@ class BuildTest(IGVMTest):
         with _get_vm(VM_HOSTNAME) as vm:
             vm.run('test ! -f /root/initial_canary')
 
+    def test_build_golden(self):
+        obj = Query({'hostname': VM_HOSTNAME}, ['disk_size_gib']).get()
+        obj['disk_size_gib'] = GOLDEN_VOLUME_SIZE_GIB * 2
+        obj.commit()
+
+        vm_build(VM_HOSTNAME, golden=True)
+        self.check_vm_present()
+
+        with _get_vm(VM_HOSTNAME) as vm:
+            # The golden volume is kept for the next builds.
+            self.assertTrue(any(
+                v.startswith('golden_')
+                for v in vm.hypervisor.get_storage_pool().listVolumes()
+            ))
+            vm.run('touch /root/initial_canary')
+
+        # The VM built from the golden volume again must not see the changes
+        # of the first one.
+        vm_stop(VM_HOSTNAME)
+        vm_build(VM_HOSTNAME, rebuild=True, golden=True)
+        self.check_vm_present()
+
+        with _get_vm(VM_HOSTNAME) as vm:
+            vm.run('test ! -f /root/initial_canary')
+
 
 class CommandTest(IGVMTest):
     def setUp(self):
@@ -550,6 +578,74 @@ class MigrationTest(IGVMTest):
         )
         self.check_vm_present()
 
+    def test_offline_migration_sparse(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='sparse',
+        )
+        self.check_vm_present()
+
+    def test_offline_migration_parallel(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='parallel',
+        )
+        self.check_vm_present()
+
+    def test_offline_migration_resumable(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='resumable',
+        )
+        self.check_vm_present()
+
+    def test_offline_migration_resumed(self):
+        # The VM is stopped not to change its disk between the attempts.
+        vm_stop(VM_HOSTNAME)
+        send = ResumableTransfer.send
+        attempts = []
+
+        def send_half(transfer, chunks):
+            attempts.append(chunks)
+            send(transfer, chunks[:len(chunks) // 2])
+            raise IGVMError('Interrupted the transfer')
+
+        def send_all(transfer, chunks):
+            attempts.append(chunks)
+            send(transfer, chunks)
+
+        with patch.object(ResumableTransfer, 'send', send_half):
+            with self.assertRaises(IGVMError):
+                vm_migrate(
+                    VM_HOSTNAME,
+                    offline=True,
+                    offline_transport='resumable',
+                )
+        with patch.object(ResumableTransfer, 'send', send_all):
+            vm_migrate(
+                VM_HOSTNAME,
+                offline=True,
+                offline_transport='resumable',
+            )
+
+        # Only the chunks missing after the first attempt are sent again.
+        first, second = attempts
+        self.assertEqual(second, first[len(first) // 2:])
+
+        vm_start(VM_HOSTNAME)
+        self.check_vm_present()
+
+    def test_offline_migration_precopy(self):
+        vm_migrate(
+            VM_HOSTNAME,
+            offline=True,
+            offline_transport='precopy',
+        )
+        self.check_vm_present()
+
     def test_offline_migration_drbd(self):
         vm_migrate(
             VM_HOSTNAME,
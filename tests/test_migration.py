@@ -0,0 +1,110 @@
+"""igvm - Live Migration Monitor Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from libvirt import libvirtError
+
+from igvm.migration import LiveMigrationMonitor
+from igvm.settings import (
+    LIVE_MIGRATION_MAX_DOWNTIME_MS,
+    LIVE_MIGRATION_STALL_TIME,
+)
+
+MiB = 1024 ** 2
+STALL = LIVE_MIGRATION_STALL_TIME
+
+# Times and remaining memory of the samples with the expected maximum
+# downtime and whether the migration is aborted after them.  The dirty
+# rate is twice the transfer rate, so the migration does not converge.
+STALLING = [
+    (0, 1024 * MiB, 300, False),
+    (STALL // 2, 1024 * MiB, 300, False),
+    (STALL, 1024 * MiB, LIVE_MIGRATION_MAX_DOWNTIME_MS, False),
+    (STALL * 3 // 2, 1024 * MiB, LIVE_MIGRATION_MAX_DOWNTIME_MS, False),
+    (STALL * 2, 1024 * MiB, LIVE_MIGRATION_MAX_DOWNTIME_MS, True),
+    (STALL * 3, 1024 * MiB, LIVE_MIGRATION_MAX_DOWNTIME_MS, True),
+]
+
+# The remaining memory reaching new lows is not stalling.
+CONVERGING = [
+    (0, 1024 * MiB, 300, False),
+    (STALL // 2, 1000 * MiB, 300, False),
+    (STALL, 900 * MiB, 300, False),
+    (STALL * 3 // 2, 800 * MiB, 300, False),
+    (STALL * 2, 900 * MiB, 300, False),
+    (STALL * 5 // 2, 700 * MiB, 300, False),
+]
+
+
+def _stats(memory_remaining):
+    return {
+        'time_elapsed': 0,
+        'memory_total': 4096 * MiB,
+        'memory_processed': 4096 * MiB - memory_remaining,
+        'memory_remaining': memory_remaining,
+        'memory_bps': 100 * MiB,
+        'memory_dirty_rate': 200 * MiB // 4096,
+        'memory_page_size': 4096,
+        'memory_iteration': 3,
+    }
+
+
+class _Host(object):
+    def __init__(self, fqdn):
+        self.fqdn = fqdn
+
+    def __str__(self):
+        return self.fqdn
+
+
+class LiveMigrationMonitorTest(TestCase):
+    def setUp(self):
+        self.domain = Mock()
+        self.domain.migrateGetMaxDowntime.return_value = 300
+        self.monitor = LiveMigrationMonitor(
+            self.domain,
+            _Host('vm.example.com'),
+            _Host('hv1.example.com'),
+            _Host('hv2.example.com'),
+            policies=['downtime', 'abort'],
+            record_path=None,
+        )
+
+    def _run(self, samples):
+        with patch('igvm.migration.time') as time:
+            for now, memory_remaining, downtime, aborted in samples:
+                time.return_value = now
+                self.monitor.update(_stats(memory_remaining))
+                self.assertEqual(self.monitor.downtime, downtime, msg=now)
+                self.assertEqual(
+                    self.monitor.abort_reason is not None, aborted, msg=now
+                )
+
+    def test_stalling(self):
+        self._run(STALLING)
+        self.domain.migrateSetMaxDowntime.assert_called_once_with(
+            LIVE_MIGRATION_MAX_DOWNTIME_MS, 0
+        )
+        self.domain.abortJob.assert_called_once_with()
+        self.assertEqual(self.monitor.policies, [])
+
+    def test_converging(self):
+        self._run(CONVERGING)
+        self.domain.migrateSetMaxDowntime.assert_not_called()
+        self.domain.abortJob.assert_not_called()
+
+    def test_finished_job(self):
+        # The job may finish before the policy is applied.
+        self.domain.migrateSetMaxDowntime.side_effect = libvirtError(
+            'no job is active on the domain'
+        )
+        self._run([(0, 1024 * MiB, 300, False)])
+        with patch('igvm.migration.time', return_value=STALL):
+            self.monitor.update(_stats(1024 * MiB))
+        self.assertIsNone(self.monitor.abort_reason)
+        self.assertEqual(self.monitor.policies, [])
+        self.domain.abortJob.assert_not_called()
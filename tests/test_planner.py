@@ -0,0 +1,141 @@
+"""igvm - Placement Planner Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from os import close, remove
+from tempfile import mkstemp
+from unittest import TestCase
+
+from igvm.planner import PlacementPlanner, load_plan, save_plan
+
+
+class _Hypervisor(object):
+    def __init__(self, fqdn, memory=8192, num_cpu=32, vms=()):
+        self.fqdn = fqdn
+        self.dataset_obj = {
+            'hostname': fqdn,
+            'disk_size_gib': 1024,
+            'memory': memory,
+            'num_cpu': num_cpu,
+            'cpu_util_pct': 10,
+            'cpu_util_vm_pct': 10,
+            'iops_avg': 10,
+            'vms': list(vms),
+        }
+
+    def __str__(self):
+        return self.fqdn
+
+    def __lt__(self, other):
+        return self.fqdn < other.fqdn
+
+    def get_vlan_network(self, ip_address):
+        return True
+
+
+class _VM(object):
+    def __init__(self, fqdn, hypervisor, memory=1024, **attributes):
+        self.fqdn = fqdn
+        self.hypervisor = hypervisor
+        self.dataset_obj = {
+            'hostname': fqdn,
+            'intern_ip': '192.0.2.1',
+            'memory': memory,
+            'disk_size_gib': 10,
+            'num_cpu': 2,
+            'project': 'project',
+            'function': fqdn.split('.', 1)[0],
+            'environment': 'testing',
+            'game_market': None,
+            'game_world': None,
+            'game_type': None,
+        }
+        self.dataset_obj.update(attributes)
+        hypervisor.dataset_obj['vms'].append(self.dataset_obj)
+
+    def __str__(self):
+        return self.fqdn
+
+
+class PlacementPlannerTest(TestCase):
+    def setUp(self):
+        self.source = _Hypervisor('source.example.com')
+        self.hypervisors = [
+            _Hypervisor('hv1.example.com', memory=4096),
+            _Hypervisor('hv2.example.com', memory=4096),
+        ]
+        self.planner = PlacementPlanner(self.hypervisors)
+
+    def _memory(self, hypervisor):
+        return sum(v['memory'] for v in hypervisor.dataset_obj['vms'])
+
+    def test_capacity_exhaustion(self):
+        vms = [
+            (_VM('large.example.com', self.source, 4096), False),
+            (_VM('small1.example.com', self.source, 2048), False),
+            (_VM('small2.example.com', self.source, 2048), True),
+            (_VM('small3.example.com', self.source, 2048), False),
+        ]
+
+        plan = self.planner.plan(vms)
+
+        self.assertEqual(len(plan['migrations']), 3)
+        self.assertEqual(
+            plan['migrations'][0]['vm_hostname'], 'large.example.com'
+        )
+        self.assertEqual(len(plan['unplaced']), 1)
+        for hypervisor in self.hypervisors:
+            self.assertEqual(self._memory(hypervisor), 4096)
+
+    def test_anti_affinity(self):
+        vms = [
+            _VM('db1.example.com', self.source, function='db'),
+            _VM('db2.example.com', self.source, function='db'),
+        ]
+
+        first = self.planner.choose(vms[0])
+        self.planner.assign(vms[0], first)
+        second = self.planner.choose(vms[1])
+
+        self.assertIsNotNone(second)
+        self.assertNotEqual(first, second)
+
+    def test_exclude(self):
+        vm = _VM('vm.example.com', self.source)
+
+        self.assertIsNone(self.planner.choose(vm, exclude=set(
+            self.hypervisors
+        )))
+
+    def test_unassign(self):
+        large = _VM('large.example.com', self.source, 4096)
+        hypervisor = self.planner.choose(large)
+        self.planner.assign(large, hypervisor)
+        self.assertFalse(self.planner.fits(large, hypervisor))
+
+        self.planner.unassign(large, hypervisor)
+
+        self.assertTrue(self.planner.fits(large, hypervisor))
+        self.assertEqual(hypervisor.dataset_obj['vms'], [])
+
+    def test_plan_round_trip(self):
+        vms = [
+            (_VM('vm1.example.com', self.source), False),
+            (_VM('vm2.example.com', self.source), True),
+        ]
+        plan = self.planner.plan(vms)
+
+        fd, path = mkstemp(suffix='.json')
+        close(fd)
+        try:
+            save_plan(plan, path)
+            loaded = load_plan(path)
+        finally:
+            remove(path)
+
+        self.assertEqual(loaded, {
+            m['vm_hostname']: m for m in plan['migrations']
+        })
+        self.assertTrue(loaded['vm2.example.com']['offline'])
+        self.assertFalse(loaded['vm1.example.com']['offline'])
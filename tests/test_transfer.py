@@ -0,0 +1,54 @@
+"""igvm - Block Transfer Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from unittest import TestCase
+
+from igvm.settings import MIGRATE_CHUNK_SIZE_MIB
+from igvm.transfer import ResumableTransfer
+
+MiB = 1024 ** 2
+CHUNK = MIGRATE_CHUNK_SIZE_MIB * MiB
+# Three full chunks and a short last one
+SIZE = 3 * CHUNK + 8 * MiB
+FIRST = (0, MIGRATE_CHUNK_SIZE_MIB)
+SECOND = (MIGRATE_CHUNK_SIZE_MIB, MIGRATE_CHUNK_SIZE_MIB)
+LAST = (3 * MIGRATE_CHUNK_SIZE_MIB, 8)
+
+# Changed byte ranges with the places of the chunks they touch
+CHANGES = [
+    ([], []),
+    ([(0, 1)], [FIRST]),
+    ([(0, CHUNK)], [FIRST]),
+    ([(CHUNK - 1, 1)], [FIRST]),
+    ([(CHUNK - 1, 2)], [FIRST, SECOND]),
+    ([(CHUNK, 1)], [SECOND]),
+    ([(CHUNK, CHUNK)], [SECOND]),
+    ([(CHUNK + 4096, 4096), (CHUNK, 4096)], [SECOND]),
+    ([(SIZE - 1, 1)], [LAST]),
+    ([(3 * CHUNK, CHUNK)], [LAST]),
+    ([(0, 4096), (SIZE - 4096, 4096)], [FIRST, LAST]),
+]
+
+
+class ResumableTransferTest(TestCase):
+    def setUp(self):
+        self.transfer = ResumableTransfer(
+            None, '/dev/source', None, '/dev/target', SIZE
+        )
+
+    def test_places(self):
+        places = self.transfer.get_places()
+        self.assertEqual(len(places), 4)
+        self.assertEqual(places[0], FIRST)
+        self.assertEqual(places[-1], LAST)
+        self.assertEqual(sum(p[1] for p in places) * MiB, SIZE)
+
+    def test_changed_places(self):
+        for changes, expected in CHANGES:
+            self.assertEqual(
+                self.transfer.get_changed_places(changes),
+                expected,
+                msg=changes,
+            )
@@ -0,0 +1,52 @@
+"""igvm - VM Tests
+
+Copyright (c) 2018 InnoGames GmbH
+"""
+
+from subprocess import PIPE, STDOUT, run
+from unittest import TestCase
+from unittest.mock import patch
+
+from igvm.exceptions import RemoteCommandError
+from igvm.transaction import Transaction
+from igvm.vm import VM
+
+
+def _run_locally(command, **kwargs):
+    """Run the command here instead of on the VM"""
+    return run(
+        ['/bin/sh', '-c', command], stdout=PIPE, stderr=STDOUT
+    ).stdout.decode()
+
+
+@patch('fabric.api.sudo', side_effect=_run_locally)
+class BatchTest(TestCase):
+    def setUp(self):
+        self.vm = VM({
+            'hostname': 'igvm-test.example.com',
+            'intern_ip': '192.0.2.1',
+            'object_id': 1,
+        })
+
+    def test_batch(self, sudo):
+        with self.vm.batch() as batch:
+            batch.run('echo foo')
+            batch.run('true')
+
+        self.assertEqual(sudo.call_count, 1)
+        self.assertFalse(sudo.call_args[1]['pty'])
+        self.assertEqual(batch.results, [(0, 'foo'), (0, '')])
+
+    def test_batch_failure(self, sudo):
+        with self.assertRaises(RemoteCommandError):
+            with Transaction() as transaction:
+                with self.vm.batch(transaction) as batch:
+                    batch.run('true', rollback='echo undo')
+                    batch.run('echo bar ; exit 3', rollback='echo never')
+                    batch.run('echo skipped')
+
+        self.assertEqual(batch.results, [(0, ''), (3, 'bar')])
+        # Only the rollback of the succeeded step is run.
+        commands = [c[0][0] for c in sudo.call_args_list]
+        self.assertIn('echo undo', commands)
+        self.assertNotIn('echo never', commands)